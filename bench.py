@@ -0,0 +1,433 @@
+"""
+🧪 Нагрузочный тест YESsignals_bot без сети
+
+Синтетические обновления Telegram для множества пользователей проходят
+через обработчики бота (как в webhook-режиме: Update.de_json ->
+Application.process_update). Бот-заглушка не ходит в Telegram,
+CoinGecko заменен локальным aiohttp-сервером с настраиваемой
+задержкой, ошибками и 429.
+
+Примеры:
+    python bench.py --requests 5000 --users 1000 --concurrency 64
+    python bench.py --db-backend sqlite --write-mode sync
+    python bench.py --latency 200 --error-rate 0.1 --throttle-rate 0.2
+    python bench.py --recorded simple_price.json --json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+from datetime import datetime, timedelta, timezone
+from aiohttp import web
+from telegram import Bot, Chat, Message, User
+
+# Меню бота и их доля в нагрузке
+DEFAULT_MIX = {
+    '🎯 Сигналы': 4,
+    '📈 Pump/Dump': 2,
+    '💎 Подписка': 1,
+    '🆘 Поддержка': 1,
+    '/start': 1,
+    '/signals': 1,
+    '/signals C7': 1,
+    'callback:back': 1
+}
+
+def percentile(ordered, q):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+# ================== ЗАГЛУШКА COINGECKO ==================
+class CoinGeckoStub:
+    """Локальный сервер /simple/price и /coins/markets.
+
+    Цены - синтетическое случайное блуждание или записанный ответ
+    /simple/price (--recorded). Перед ответом выдерживается задержка,
+    часть запросов завершается 500 или 429 с Retry-After.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0,
+                 retry_after=1, recorded=None, markets=500, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.recorded = recorded
+        self.markets = markets
+        self.rng = random.Random(seed)
+        self.prices = {}
+        self.stats = {'simple_price': 0, 'coins_markets': 0, 'coins_list': 0, 'errors': 0, 'throttled': 0}
+        self._runner = None
+        self.url = None
+    
+    def _price(self, coin_id):
+        """Случайное блуждание цены монеты между запросами"""
+        price = self.prices.get(coin_id)
+        if price is None:
+            price = 10 ** random.Random(coin_id).uniform(-3, 4.5)
+        price *= 1 + self.rng.gauss(0, 0.002)
+        self.prices[coin_id] = price
+        return price
+    
+    async def _fault(self):
+        """Задержка и, возможно, ошибочный ответ"""
+        delay = self.latency + self.rng.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        roll = self.rng.random()
+        if roll < self.throttle_rate:
+            self.stats['throttled'] += 1
+            return web.json_response(
+                {'status': {'error_code': 429, 'error_message': 'rate limited'}},
+                status=429, headers={'Retry-After': str(self.retry_after)}
+            )
+        if roll < self.throttle_rate + self.error_rate:
+            self.stats['errors'] += 1
+            return web.json_response({'error': 'stub error'}, status=500)
+        return None
+    
+    async def simple_price(self, request):
+        self.stats['simple_price'] += 1
+        fault = await self._fault()
+        if fault is not None:
+            return fault
+        
+        ids = [coin_id for coin_id in request.query.get('ids', '').split(',') if coin_id]
+        if self.recorded is not None:
+            return web.json_response({coin_id: self.recorded[coin_id] for coin_id in ids if coin_id in self.recorded})
+        
+        now = int(time.time())
+        return web.json_response({
+            coin_id: {
+                'usd': self._price(coin_id),
+                'usd_24h_change': self.rng.uniform(-15, 15),
+                'last_updated_at': now
+            }
+            for coin_id in ids
+        })
+    
+    async def coins_markets(self, request):
+        self.stats['coins_markets'] += 1
+        fault = await self._fault()
+        if fault is not None:
+            return fault
+        
+        per_page = int(request.query.get('per_page', 100))
+        page = int(request.query.get('page', 1))
+        start = (page - 1) * per_page
+        rows = []
+        for rank in range(start, min(start + per_page, self.markets)):
+            coin_id = f"coin-{rank}"
+            price = self._price(coin_id)
+            rows.append({
+                'id': coin_id,
+                'symbol': f"c{rank}",
+                'current_price': price,
+                'market_cap': price * 1e9 / (rank + 1),
+                'market_cap_rank': rank + 1,
+                'total_volume': price * 1e7 / (rank + 1),
+                # Редкие сильные движения, чтобы сканеру было что находить
+                'price_change_percentage_1h_in_currency': self.rng.gauss(0, 0.8) * (8 if self.rng.random() < 0.01 else 1),
+                'price_change_percentage_24h': self.rng.gauss(0, 4) * (5 if self.rng.random() < 0.01 else 1)
+            })
+        return web.json_response(rows)
+    
+    async def coins_list(self, request):
+        self.stats['coins_list'] += 1
+        fault = await self._fault()
+        if fault is not None:
+            return fault
+        
+        return web.json_response([
+            {'id': f"coin-{rank}", 'symbol': f"c{rank}", 'name': f"Coin {rank}"}
+            for rank in range(self.markets)
+        ])
+    
+    async def start(self, host='127.0.0.1', port=0):
+        app = web.Application()
+        app.router.add_get('/api/v3/simple/price', self.simple_price)
+        app.router.add_get('/api/v3/coins/markets', self.coins_markets)
+        app.router.add_get('/api/v3/coins/list', self.coins_list)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}/api/v3"
+        return self.url
+    
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+# ================== ЗАГЛУШКА TELEGRAM ==================
+class BenchBot(Bot):
+    """Bot без сети: сообщения только считаются"""
+
+    def __init__(self, send_latency=0.0):
+        super().__init__(token="123456:BENCH")
+        self._send_latency = send_latency
+        self._message_ids = iter(range(1, 1 << 62))
+        self._sent = {'messages': 0, 'chars': 0}
+        self._me = User(id=123456, first_name="Bench", is_bot=True, username="bench_bot")
+    
+    @property
+    def sent(self):
+        return self._sent
+    
+    async def get_me(self, *args, **kwargs):
+        self._bot_user = self._me
+        return self._me
+    
+    async def send_message(self, chat_id, text, *args, **kwargs):
+        if self._send_latency:
+            await asyncio.sleep(self._send_latency)
+        self._sent['messages'] += 1
+        self._sent['chars'] += len(text)
+        return Message(
+            message_id=next(self._message_ids),
+            date=datetime.now(timezone.utc),
+            chat=Chat(id=chat_id, type=Chat.PRIVATE),
+            text=text
+        )
+    
+    async def delete_message(self, *args, **kwargs):
+        return True
+    
+    async def answer_callback_query(self, *args, **kwargs):
+        return True
+
+# ================== СИНТЕТИЧЕСКИЕ ОБНОВЛЕНИЯ ==================
+def make_update_payload(update_id, user_id, action):
+    """JSON обновления в том виде, в каком его присылает Telegram"""
+    sender = {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}", 'username': f"user{user_id}"}
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': sender
+    }
+    if action.startswith('callback:'):
+        return {
+            'update_id': update_id,
+            'callback_query': {
+                'id': str(update_id),
+                'from': sender,
+                'chat_instance': 'bench',
+                'data': action.split(':', 1)[1],
+                'message': {**message, 'text': 'menu'}
+            }
+        }
+    
+    message['text'] = action
+    if action.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(action.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+# ================== ПРОГОН ==================
+def db_files_size(bot_module):
+    """Размер файлов хранилища (для sqlite учитывается WAL)"""
+    paths = [bot_module.DB_FILE, bot_module.DB_JOURNAL_FILE,
+             bot_module.DB_SQLITE_FILE, bot_module.DB_SQLITE_FILE + "-wal"]
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+async def wait_for_snapshot(bot_module, timeout):
+    deadline = time.monotonic() + timeout
+    while bot_module.market_poller.snapshot.version == 0 and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    return bot_module.market_poller.snapshot.version > 0
+
+async def run(args):
+    stub = CoinGeckoStub(
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        recorded=json.load(open(args.recorded, encoding='utf-8')) if args.recorded else None,
+        markets=args.markets,
+        seed=args.seed
+    )
+    
+    # Конфигурация бота читается при импорте - окружение готовим заранее
+    os.environ.update({
+        'COINGECKO_API_URL': await stub.start(),
+        'COINGECKO_RATE_PER_MINUTE': str(args.upstream_rate),
+        'DB_FILE': os.path.join(args.db_dir, 'users_db.json'),
+        'DB_SQLITE_FILE': os.path.join(args.db_dir, 'users_db.sqlite3'),
+        'MARKET_SNAPSHOT_FILE': os.path.join(args.db_dir, 'market_snapshot.npy'),
+        'COIN_REGISTRY_FILE': os.path.join(args.db_dir, 'coin_registry.json'),
+        'DB_BACKEND': args.db_backend,
+        'DB_WRITE_MODE': args.write_mode,
+        'MARKET_POLL_INTERVAL': str(args.poll_interval),
+        'PUMPDUMP_SCAN_INTERVAL': str(args.poll_interval),
+        'PUMPDUMP_TOP_N': str(args.markets),
+        'CONCURRENT_UPDATES': str(args.concurrency)
+    })
+    import bot as bot_module
+    from telegram import Update
+    from telegram.ext import Application
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    
+    # Лимиты Telegram замеряются отдельно; по умолчанию отправка не ограничена
+    bot_module.outbound = bot_module.OutboundSender(
+        rate=args.telegram_rate, chat_rate=args.telegram_rate, chat_burst=args.telegram_rate
+    )
+    
+    telegram_bot = BenchBot(send_latency=args.send_latency / 1000)
+    application = Application.builder().bot(telegram_bot).updater(None).build()
+    bot_module.register_handlers(application)
+    await application.initialize()
+    await bot_module.on_startup(application)
+    if not await wait_for_snapshot(bot_module, timeout=10):
+        print("⚠️ Снимок рынка не загружен - обработчики работают на резервных данных")
+    
+    rng = random.Random(args.seed)
+    user_ids = [10_000_000 + i for i in range(args.users)]
+    expiry = (datetime.now() + timedelta(days=30)).isoformat()
+    for user_id in rng.sample(user_ids, int(args.users * args.premium_share)):
+        bot_module.user_db.get_user(user_id)
+        bot_module.user_db.update_user(user_id, {'is_premium': True, 'premium_expiry': expiry})
+    
+    actions, weights = zip(*DEFAULT_MIX.items())
+    workload = [
+        (update_id, rng.choice(user_ids), action)
+        for update_id, action in enumerate(rng.choices(actions, weights, k=args.requests), start=1)
+    ]
+    
+    latencies = {action: [] for action in actions}
+    bytes_before = sum(bot_module.DB_BYTES_WRITTEN.values.values())
+    files_before = db_files_size(bot_module)
+    sent_before = telegram_bot.sent['messages']
+    
+    queue = asyncio.Queue()
+    for item in workload:
+        queue.put_nowait(item)
+    
+    async def worker():
+        while not queue.empty():
+            update_id, user_id, action = queue.get_nowait()
+            update = Update.de_json(make_update_payload(update_id, user_id, action), telegram_bot)
+            start = time.perf_counter()
+            await application.process_update(update)
+            latencies[action].append(time.perf_counter() - start)
+    
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    # SQLite пишет в WAL, который сворачивается при закрытии - размер до остановки
+    file_growth = db_files_size(bot_module) - files_before
+    
+    # Журнал сбрасывается пачками - дожидаемся записи перед подсчетом байт
+    await bot_module.on_shutdown(application)
+    await application.shutdown()
+    await stub.stop()
+    
+    db_bytes = sum(bot_module.DB_BYTES_WRITTEN.values.values()) - bytes_before
+    if args.db_backend == 'sqlite':
+        # Запись SQLite не инструментирована - считаем по росту файлов
+        db_bytes = max(file_growth, 0)
+    all_latencies = sorted(value for values in latencies.values() for value in values)
+    return {
+        'config': {key: value for key, value in vars(args).items() if key != 'db_dir'},
+        'requests': args.requests,
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(args.requests / elapsed, 1),
+        'latency_ms': {
+            'p50': round(percentile(all_latencies, 0.5) * 1000, 3),
+            'p90': round(percentile(all_latencies, 0.9) * 1000, 3),
+            'p99': round(percentile(all_latencies, 0.99) * 1000, 3),
+            'max': round(all_latencies[-1] * 1000, 3) if all_latencies else 0.0
+        },
+        'by_action': {
+            action: {
+                'count': len(values),
+                'p50_ms': round(percentile(sorted(values), 0.5) * 1000, 3),
+                'p99_ms': round(percentile(sorted(values), 0.99) * 1000, 3)
+            }
+            for action, values in latencies.items() if values
+        },
+        'db': {
+            'bytes_written': int(db_bytes),
+            'bytes_per_request': round(db_bytes / args.requests, 1),
+            'file_growth_bytes': file_growth
+        },
+        'telegram_messages': telegram_bot.sent['messages'] - sent_before,
+        'handler_errors': int(sum(bot_module.HANDLER_ERRORS.values.values())),
+        'upstream': stub.stats,
+        'coingecko_client': {
+            'cache': dict(bot_module.coingecko_client.cache.stats),
+            'fallback': int(sum(bot_module.FALLBACK_DATA.values.values())),
+            **bot_module.coingecko_client.scheduler.state()
+        }
+    }
+
+def print_report(report):
+    latency = report['latency_ms']
+    db = report['db']
+    print("=" * 60)
+    print(f"📊 Запросов: {report['requests']} за {report['seconds']} сек "
+          f"({report['throughput_rps']} запр/сек)")
+    print(f"⏱ Задержка, мс: p50={latency['p50']} p90={latency['p90']} "
+          f"p99={latency['p99']} max={latency['max']}")
+    print("-" * 60)
+    for action, stats in report['by_action'].items():
+        print(f"  {action:<16} n={stats['count']:<6} p50={stats['p50_ms']:<8} p99={stats['p99_ms']}")
+    print("-" * 60)
+    print(f"💾 БД: {db['bytes_written']} байт записано, {db['bytes_per_request']} байт/запрос, "
+          f"рост файлов {db['file_growth_bytes']} байт")
+    print(f"✉️ Сообщений Telegram: {report['telegram_messages']}, ошибок обработчиков: {report['handler_errors']}")
+    print(f"📡 Заглушка CoinGecko: {report['upstream']}")
+    print(f"🗄 Клиент CoinGecko: {report['coingecko_client']}")
+    print("=" * 60)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест YESsignals_bot без сети")
+    parser.add_argument('--requests', type=int, default=2000, help="всего обновлений")
+    parser.add_argument('--users', type=int, default=500, help="число пользователей")
+    parser.add_argument('--premium-share', type=float, default=0.2, help="доля премиум пользователей")
+    parser.add_argument('--concurrency', type=int, default=32, help="одновременно обрабатываемых обновлений")
+    parser.add_argument('--db-backend', choices=('json', 'sqlite'), default='json')
+    parser.add_argument('--write-mode', choices=('sync', 'journal'), default='journal')
+    parser.add_argument('--db-dir', help="каталог для файлов БД (по умолчанию временный)")
+    parser.add_argument('--latency', type=float, default=50.0, help="задержка CoinGecko, мс")
+    parser.add_argument('--jitter', type=float, default=20.0, help="случайная добавка к задержке, мс")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument('--retry-after', type=int, default=1, help="Retry-After в ответах 429, сек")
+    parser.add_argument('--recorded', help="JSON записанного ответа /simple/price")
+    parser.add_argument('--markets', type=int, default=500, help="монет в /coins/markets")
+    parser.add_argument('--upstream-rate', type=int, default=600, help="лимит запросов к CoinGecko в минуту")
+    parser.add_argument('--poll-interval', type=int, default=5, help="интервал обновления снимка рынка, сек")
+    parser.add_argument('--send-latency', type=float, default=0.0, help="задержка отправки сообщения, мс")
+    parser.add_argument('--telegram-rate', type=float, default=1e9, help="лимит отправки сообщений в секунду")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help="вывести отчет в JSON")
+    parser.add_argument('--verbose', action='store_true', help="логи бота уровня INFO")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.db_dir:
+        report = asyncio.run(run(args))
+    else:
+        with tempfile.TemporaryDirectory(prefix="bench_") as db_dir:
+            args.db_dir = db_dir
+            report = asyncio.run(run(args))
+    
+    if args.json:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    else:
+        print_report(report)
+
+if __name__ == "__main__":
+    main()
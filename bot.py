@@ -4,31 +4,278 @@
 """
 
 import os
+import sys
+import csv
+import io
 import json
+import shutil
+import sqlite3
 import random
+import hmac
+import time
+import signal
+import string
+import heapq
+import bisect
+import functools
+import itertools
+import threading
+import warnings
+import weakref
+import atexit
+import queue
 import asyncio
 import logging
-import requests
-from datetime import datetime, timedelta
+import contextvars
+import socket
+import multiprocessing
+import tempfile
+import aiohttp
+import numpy as np
+from aiohttp import web
+from types import MappingProxyType
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing import shared_memory
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from contextlib import asynccontextmanager, contextmanager
+from datetime import date, datetime, timedelta
+from email.utils import parsedate_to_datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+from telegram.error import RetryAfter, TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+from flask import Flask, request
+from waitress import create_server
 
-# ================== НАСТРОЙКА ==================
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# ================== ЛОГИ ==================
+# Обработчики только кладут запись в очередь; форматирование и запись
+# в stdout/файл идут в потоке QueueListener и не задерживают event loop
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text или json
+LOG_FILE = os.getenv("LOG_FILE", "")  # дополнительно писать в файл
+LOG_QUEUE_SIZE = 10000  # записей в очереди; при переполнении новые отбрасываются
+LOG_SAMPLE_RATE = int(os.getenv("LOG_SAMPLE_RATE", "100"))  # из частых info-записей пишется 1 из N
+LOG_TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# id обновления Telegram и пользователя для записей, сделанных в обработчике
+log_request_id = contextvars.ContextVar("log_request_id", default=None)
+log_user_id = contextvars.ContextVar("log_user_id", default=None)
+
+# extra для частых info-записей горячего пути (сэмплируются)
+SAMPLED = {"sample": True}
+
+class LogSampler(logging.Filter):
+    """Из частых записей (extra=SAMPLED) пропускает первую и далее каждую rate-ю по шаблону сообщения"""
+    
+    def __init__(self, rate=LOG_SAMPLE_RATE):
+        super().__init__()
+        self.rate = max(1, rate)
+        self.counts = {}
+    
+    def filter(self, record):
+        if not getattr(record, "sample", False) or record.levelno >= logging.WARNING:
+            return True
+        count = self.counts.get(record.msg, 0)
+        self.counts[record.msg] = count + 1
+        if count % self.rate:
+            return False
+        record.sample_rate = self.rate
+        return True
+
+class LogContextFilter(logging.Filter):
+    """id запроса и пользователя из contextvars (в потоке, где вызван logger)"""
+    
+    def filter(self, record):
+        record.request_id = log_request_id.get()
+        record.user_id = log_user_id.get()
+        return True
+
+class JsonLogFormatter(logging.Formatter):
+    """Одна JSON-строка на запись"""
+    
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        for field in ("request_id", "user_id", "sample_rate"):
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class LogQueueHandler(QueueHandler):
+    """Запись в очередь без форматирования и без ожидания"""
+    
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+    
+    def prepare(self, record):
+        # Сообщение собирается из msg и args в потоке QueueListener -
+        # в args передаются неизменяемые значения
+        return record
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logging():
+    """Корневой логгер -> очередь -> поток QueueListener -> stdout и LOG_FILE"""
+    formatter = JsonLogFormatter() if LOG_FORMAT == "json" else logging.Formatter(LOG_TEXT_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if LOG_FILE:
+        handlers.append(logging.FileHandler(LOG_FILE, encoding="utf-8"))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = LogQueueHandler(log_queue)
+    queue_handler.addFilter(LogSampler())
+    queue_handler.addFilter(LogContextFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # При выходе listener дописывает оставшиеся записи
+    atexit.register(listener.stop)
+    return queue_handler
+
+log_handler = setup_logging()
 logger = logging.getLogger(__name__)
 
+# ================== НАСТРОЙКА ==================
+
 # Конфигурация из переменных окружения
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
 
-DB_FILE = "users_db.json"
+DB_FILE = os.getenv("DB_FILE", "users_db.json")
+
+# Хранилище пользователей: json (users_db.json) или sqlite
+DB_BACKEND = os.getenv("DB_BACKEND", "json")
+DB_SQLITE_FILE = os.getenv("DB_SQLITE_FILE", "users_db.sqlite3")
+
+# Режим записи БД: sync - полная перезапись файла при каждом изменении,
+# journal - write-behind журнал изменений + периодическая компакция
+DB_WRITE_MODE = os.getenv("DB_WRITE_MODE", "sync")
+DB_JOURNAL_FILE = os.getenv("DB_JOURNAL_FILE", DB_FILE + ".journal")
+JOURNAL_FSYNC_BATCH = 200  # записей, после которых fsync запускается досрочно
+JOURNAL_FSYNC_INTERVAL = 1.0  # максимум секунд между fsync
+JOURNAL_COMPACT_RECORDS = 50000  # записей в журнале до компакции
+JOURNAL_COMPACT_INTERVAL = 600  # секунд между компакциями
 
 # CoinGecko API конфигурация
-COINGECKO_API_URL = "https://api.coingecko.com/api/v3"
+# Последний успешный снимок цен на диске: теплый старт и данные при недоступности API
+MARKET_SNAPSHOT_FILE = os.getenv("MARKET_SNAPSHOT_FILE", "market_snapshot.npy")
+
+COINGECKO_API_URL = os.getenv("COINGECKO_API_URL", "https://api.coingecko.com/api/v3")
 COINGECKO_TIMEOUT = 10
+COINGECKO_POOL_SIZE = 20  # максимум одновременных соединений
+COINGECKO_KEEPALIVE = 30  # секунд держим соединение открытым
+COINGECKO_CACHE_SIZE = 2000  # максимум записей в кеше цен
+COINGECKO_CACHE_TTL = 60  # секунд данные считаются свежими
+COINGECKO_STALE_TTL = 600  # секунд после записи можно отдавать устаревшие данные
+
+# Лимиты CoinGecko (бесплатный тариф ~30 запросов в минуту)
+COINGECKO_RATE_PER_MINUTE = int(os.getenv("COINGECKO_RATE_PER_MINUTE", "30"))
+COINGECKO_BURST = 5  # запросов подряд без ожидания
+COINGECKO_MARKETS_PAGE_SIZE = 250  # максимум CoinGecko для /coins/markets
+COINGECKO_MAX_RETRIES = 3
+COINGECKO_BACKOFF_BASE = 1.0  # секунд
+COINGECKO_BACKOFF_MAX = 30.0  # секунд
+COINGECKO_RETRY_AFTER_MAX = 300  # максимум секунд паузы по Retry-After
+BREAKER_FAILURE_THRESHOLD = 5  # ошибок подряд до размыкания
+BREAKER_RESET_TIMEOUT = 60  # секунд до пробного запроса
+
+# Получение обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный https-адрес бота
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # обязателен: проверяется в каждом запросе Telegram
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_THREADS = int(os.getenv("WEBHOOK_THREADS", "8"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# Процессы-обработчики webhook (1 - все в одном процессе). При WORKERS > 1
+# главный процесс получает рыночные данные и ведет фоновые задачи, а воркеры
+# принимают обновления на общем порту (SO_REUSEPORT) и читают снимок рынка
+# из разделяемой памяти. Нужны BOT_MODE=webhook и DB_BACKEND=sqlite
+WORKERS = int(os.getenv("WORKERS", "1"))
+SHARED_SNAPSHOT_CAPACITY = 4096  # строк (монет) в разделяемом снимке
+SHARED_SNAPSHOT_POLL = 0.5  # секунд между проверками нового снимка в воркере
+WORKER_SYNC_INTERVAL = 5  # секунд между проверками реестра монет и результата сканера в воркере
+WORKER_STOP_TIMEOUT = 10  # секунд ждем завершения воркера
+RELAY_SOCKET = "relay.sock"  # unix-сокет главного процесса для запросов монет из воркеров
+RELAY_TIMEOUT = COINGECKO_TIMEOUT * 2  # запрос через главный процесс включает ожидание лимита
+SCAN_RESULT_FILE = "pumpdump_scan.json"  # результат сканера для воркеров
+
+# Метрики Prometheus: /metrics на отдельном сервере METRICS_HOST:METRICS_PORT
+# (0 - не запускать), не на публичном webhook-порту. В многопроцессном режиме
+# воркер i слушает METRICS_PORT + 1 + i
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Фоновая проверка сроков премиума
+PREMIUM_SWEEP_INTERVAL = 60  # секунд между проверками истекших подписок
+PREMIUM_SWEEP_BATCH = 1000  # максимум пользователей за одну пакетную запись
+PREMIUM_REMINDER_DAYS = 3  # за сколько дней напоминать об окончании
+PREMIUM_REMINDER_INTERVAL = 3600  # секунд между рассылками напоминаний
+
+# Активация премиума администратором
+PREMIUM_DEFAULT_DAYS = 30  # срок, если дни не указаны
+PREMIUM_MAX_DAYS = 3650  # максимум дней за одну активацию
+ACTIVATION_CSV_MAX_BYTES = 1024 * 1024  # размер CSV со списком оплат
+PREMIUM_EXPIRING_STATS_DAYS = 7  # "истекает на этой неделе" в /stats
+
+FREE_SIGNALS_PER_DAY = 1
+DAILY_STATS_DAYS = 30  # сколько дней хранить дневные счетчики в памяти
+
+# История цен в памяти (кольцевые буферы, запись на каждое обновление снимка)
+PRICE_HISTORY_SECONDS = 24 * 3600
+
+# Сканер pump/dump по топ-N монет (/coins/markets, 250 монет на страницу)
+PUMPDUMP_TOP_N = int(os.getenv("PUMPDUMP_TOP_N", "500"))
+PUMPDUMP_SCAN_INTERVAL = int(os.getenv("PUMPDUMP_SCAN_INTERVAL", "300"))
+PUMPDUMP_HISTORY_SECONDS = 24 * 3600
+PUMPDUMP_VOLATILITY_WINDOW = 6 * 3600  # окно трейлинговой волатильности
+PUMPDUMP_CHANGE_THRESHOLD = 12  # % за 24ч
+PUMPDUMP_Z_THRESHOLD = 3.0  # движение за 1ч в сигмах волатильности
+PUMPDUMP_Z_STRONG = 5.0
+PUMPDUMP_MAX_ALERTS = 10
+
+# Рассылка алертов премиум подписчикам
+PUMPDUMP_ALERT_COOLDOWN = {'1h': 3600, '24h': 6 * 3600}  # секунд между повторами по монете и окну
+PUMPDUMP_PUSH_MAX_ALERTS = 3  # максимум новых алертов за одно сканирование
+
+# Кеш готовых текстов сигналов и алертов
+RENDER_CACHE_SIZE = 5000
+
+# Таблица сигналов: сколько записей (монета, время данных) хранить для истории
+SIGNAL_TABLE_SIZE = 50000
+
+# Лимиты отправки сообщений Telegram
+TELEGRAM_GLOBAL_RATE = 30  # сообщений в секунду на бота
+TELEGRAM_CHAT_RATE = 1.0  # сообщений в секунду в один чат
+TELEGRAM_CHAT_BURST = 3  # сообщений подряд в один чат без паузы
+TELEGRAM_SEND_CONCURRENCY = 16  # одновременных запросов к Bot API
+TELEGRAM_MAX_ATTEMPTS = 5  # попыток отправки при RetryAfter
+TELEGRAM_CHAT_BUCKETS_MAX = 10000  # после этого неиспользуемые лимиты чатов удаляются
+
+# Сколько обновлений обрабатывать параллельно (1 - строго по очереди)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32"))
+
+# Фоновое обновление снимка рынка
+MARKET_POLL_INTERVAL = int(os.getenv("MARKET_POLL_INTERVAL", "60"))
 
 # Список монет для анализа (символы и их ID на CoinGecko)
 COINGECKO_IDS = {
@@ -43,9 +290,300 @@ COINGECKO_IDS = {
     'SNX': 'havven', 'CRV': 'curve-dao-token', 'SUSHI': 'sushi', '1INCH': '1inch'
 }
 
-# ================== БАЗА ДАННЫХ ==================
-class UserDatabase:
+# Реестр всех монет CoinGecko (/coins/list + ранги по капитализации)
+COIN_REGISTRY_FILE = os.getenv("COIN_REGISTRY_FILE", "coin_registry.json")
+COIN_REGISTRY_TTL = 24 * 3600  # секунд до обновления списка монет
+COIN_REGISTRY_RANKED = 1000  # монет с рангом капитализации (для выбора при совпадении символов)
+SIGNAL_TIERS = {'free': 10, 'premium': 15}  # из скольких крупнейших монет выбираются сигналы
+
+# ================== МЕТРИКИ ==================
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label(value)}"' for name, value in pairs) + '}'
+
+class Metric:
+    """Базовая метрика: значения по кортежам меток"""
+    
+    type = 'untyped'
+    
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+    
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labelnames)
+    
+    def samples(self):
+        """(суффикс, метки, значение) для вывода"""
+        for key, value in list(self.values.items()):
+            yield '', tuple(zip(self.labelnames, key)), value
+
+class Counter(Metric):
+    type = 'counter'
+    
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = 'gauge'
+    
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+class Histogram(Metric):
+    type = 'histogram'
+    
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+    
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            # [счетчики по корзинам + корзина +Inf, сумма]
+            entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+    
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+    
+    def samples(self):
+        for key, (counts, total) in list(self.values.items()):
+            labels = tuple(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), list(counts)):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield '_bucket', labels + (('le', le),), cumulative
+            yield '_sum', labels, total
+            yield '_count', labels, cumulative
+
+class CallbackMetric(Metric):
+    """Значения считываются из существующих счетчиков (stats) в момент запроса"""
+    
+    def __init__(self, name, documentation, type, collect, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.type = type
+        self.collect = collect
+    
+    def samples(self):
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in values.items():
+            yield '', tuple(zip(self.labelnames, key)), value
+
+class MetricsRegistry:
+    """Метрики процесса в текстовом формате Prometheus"""
+    
     def __init__(self):
+        self._metrics = []
+    
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+    
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+    
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+    
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+    
+    def callback(self, name, documentation, type, collect, labelnames=()):
+        return self.register(CallbackMetric(name, documentation, type, collect, labelnames))
+    
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            try:
+                for suffix, labels, value in metric.samples():
+                    lines.append(f"{metric.name}{suffix}{_format_labels(labels)} {float(value)!r}")
+            except Exception as e:
+                logger.error("Ошибка сбора метрики %s: %s", metric.name, e)
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+
+HANDLER_LATENCY = metrics.histogram(
+    'bot_handler_duration_seconds', 'Время выполнения обработчика', ('handler',))
+HANDLER_ERRORS = metrics.counter(
+    'bot_handler_errors_total', 'Необработанные исключения в обработчиках', ('handler',))
+COINGECKO_LATENCY = metrics.histogram(
+    'coingecko_request_duration_seconds', 'Время HTTP-запроса к CoinGecko', ('endpoint',))
+COINGECKO_RESPONSES = metrics.counter(
+    'coingecko_responses_total', 'Ответы CoinGecko по статусу', ('endpoint', 'status'))
+FALLBACK_DATA = metrics.counter(
+    'coingecko_fallback_total', 'Ответы резервными данными вместо CoinGecko', ('symbol',))
+DB_WRITE_LATENCY = metrics.histogram(
+    'db_snapshot_write_duration_seconds', 'Время записи снимка БД (save_db и компакция)')
+DB_BYTES_WRITTEN = metrics.counter(
+    'db_bytes_written_total', 'Байт записано в хранилище пользователей', ('kind',))
+OUTBOUND_WAIT = metrics.histogram(
+    'telegram_outbound_wait_seconds', 'Время сообщения в очереди отправки', ('lane',))
+metrics.callback(
+    'log_records_dropped_total', 'Записи лога, отброшенные при переполнении очереди', 'counter',
+    lambda: log_handler.dropped
+)
+
+def observed(handler):
+    """Гистограмма времени выполнения и счетчик ошибок обработчика"""
+    name = handler.__name__
+    
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        start = time.perf_counter()
+        # Записи лога внутри обработчика получают id обновления и пользователя
+        user = update.effective_user
+        request_token = log_request_id.set(update.update_id)
+        user_token = log_user_id.set(user.id if user else None)
+        try:
+            return await handler(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - start, handler=name)
+            log_request_id.reset(request_token)
+            log_user_id.reset(user_token)
+    
+    return wrapper
+
+# ================== БАЗА ДАННЫХ ==================
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+def current_day_epoch():
+    """Номер текущего (локального) дня от 1970-01-01"""
+    return date.today().toordinal() - EPOCH_ORDINAL
+
+def record_quota_day(user):
+    """День счетчика signals_today; для записей до перехода на номера дней -
+    из last_reset_date"""
+    day = user.get("quota_day")
+    if day is None and user.get("last_reset_date"):
+        try:
+            day = date.fromisoformat(user["last_reset_date"]).toordinal() - EPOCH_ORDINAL
+        except ValueError:
+            return None
+    return day
+
+class UserJournal:
+    """Append-only журнал изменений пользователей (fsync пачками в фоне)"""
+    
+    def __init__(self, path, fsync_batch=JOURNAL_FSYNC_BATCH):
+        self.path = path
+        self.rotated_path = path + ".1"
+        self.fsync_batch = fsync_batch
+        self.records = 0  # записей с последней компакции
+        self.pending = 0  # записей без fsync
+        self._file = None
+    
+    def open(self):
+        self._file = open(self.path, 'a', encoding='utf-8')
+    
+    def replay(self, db):
+        """Применить журнал (и незавершенную компакцию) к словарю пользователей"""
+        applied = 0
+        for path in (self.rotated_path, self.path):
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for line_no, line in enumerate(f, 1):
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Оборванная запись в конце журнала после сбоя
+                        logger.warning("⚠️ Пропущена поврежденная запись журнала %s:%s", path, line_no)
+                        continue
+                    db.setdefault(entry["k"], {}).update(entry["u"])
+                    applied += 1
+        self.records = applied
+        return applied
+    
+    def append(self, key, updates):
+        """O(1) запись изменения; fsync выполняет фоновая задача хранилища"""
+        written = self._file.write(json.dumps({"k": key, "u": updates}, ensure_ascii=False, separators=(',', ':')) + "\n")
+        DB_BYTES_WRITTEN.inc(written, kind='journal')
+        self.records += 1
+        self.pending += 1
+    
+    @property
+    def batch_full(self):
+        return self.pending >= self.fsync_batch
+    
+    def sync(self):
+        """Сбросить накопленные записи на диск (блокирующе)"""
+        if self.pending and self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.pending = 0
+    
+    async def sync_in_thread(self):
+        """fsync в отдельном потоке, не блокируя event loop"""
+        if not self.pending or self._file is None:
+            return
+        # flush в потоке event loop, чтобы не гоняться с append за буфер файла
+        self._file.flush()
+        synced = self.pending
+        await asyncio.to_thread(os.fsync, self._file.fileno())
+        self.pending -= synced
+    
+    def rotate(self):
+        """Отложить текущий журнал на время записи снимка и начать новый"""
+        self.sync()
+        self._file.close()
+        if os.path.exists(self.rotated_path):
+            # Предыдущая компакция не завершилась - дописываем к ней
+            with open(self.path, 'rb') as src, open(self.rotated_path, 'ab') as dst:
+                shutil.copyfileobj(src, dst)
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.remove(self.path)
+        elif os.path.exists(self.path):
+            os.replace(self.path, self.rotated_path)
+        self.records = 0
+        self.open()
+    
+    def drop_rotated(self):
+        """Снимок записан - отложенный журнал больше не нужен"""
+        if os.path.exists(self.rotated_path):
+            os.remove(self.rotated_path)
+    
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+class JsonUserStore:
+    """Хранилище пользователей в users_db.json (весь словарь в памяти)"""
+    
+    def __init__(self, write_mode=DB_WRITE_MODE):
+        self.journal = UserJournal(DB_JOURNAL_FILE) if write_mode == "journal" else None
+        self._last_compaction = time.monotonic()
+        self._maintenance_task = None
+        self._wakeup = None  # asyncio.Event: пачка журнала заполнена или остановка
+        self._stopping = False
         self.load_db()
     
     def load_db(self):
@@ -56,265 +594,2579 @@ class UserDatabase:
             else:
                 self.db = {}
         except Exception as e:
-            logger.error(f"Ошибка загрузки БД: {e}")
+            logger.error("Ошибка загрузки БД: %s", e)
             self.db = {}
+        
+        if self.journal is not None:
+            # Восстановление: снимок + изменения из журнала
+            replayed = self.journal.replay(self.db)
+            if replayed:
+                logger.info("📒 Из журнала восстановлено изменений: %s", replayed)
+            self.journal.open()
+    
+    def _write_snapshot(self, data):
+        """Атомарная запись снимка БД (tmp + fsync + rename)"""
+        tmp_path = DB_FILE + ".tmp"
+        payload = data.encode('utf-8')
+        with DB_WRITE_LATENCY.time():
+            with open(tmp_path, 'wb') as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, DB_FILE)
+        DB_BYTES_WRITTEN.inc(len(payload), kind='snapshot')
+    
+    def save_db(self):
+        try:
+            self._write_snapshot(json.dumps(self.db, indent=2, ensure_ascii=False))
+        except Exception as e:
+            logger.error("Ошибка сохранения БД: %s", e)
+    
+    def _persist(self, key, updates):
+        """Сохранить изменение: в журнал (O(1)) или полной перезаписью"""
+        if self.journal is None:
+            self.save_db()
+            return
+        try:
+            self.journal.append(key, updates)
+        except Exception as e:
+            logger.error("Ошибка записи в журнал БД: %s", e)
+            return
+        if self._wakeup is not None and self.journal.batch_full:
+            self._wakeup.set()
+    
+    async def compact(self):
+        """Свернуть журнал в снимок, не блокируя event loop записью на диск"""
+        data = json.dumps(self.db, indent=2, ensure_ascii=False)
+        self.journal.rotate()
+        await asyncio.to_thread(self._write_snapshot, data)
+        self.journal.drop_rotated()
+        self._last_compaction = time.monotonic()
+        logger.info("📒 Журнал БД свернут в снимок")
+    
+    def _compaction_due(self):
+        if self.journal.records >= JOURNAL_COMPACT_RECORDS:
+            return True
+        return self.journal.records > 0 and time.monotonic() - self._last_compaction >= JOURNAL_COMPACT_INTERVAL
+    
+    async def _run_maintenance(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=JOURNAL_FSYNC_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._stopping:
+                break
+            try:
+                await self.journal.sync_in_thread()
+                if self._compaction_due():
+                    await self.compact()
+            except Exception as e:
+                logger.error("Ошибка обслуживания журнала БД: %s", e)
+    
+    def start_background(self):
+        """Фоновый fsync и компакция журнала"""
+        if self.journal is not None and self._maintenance_task is None:
+            self._wakeup = asyncio.Event()
+            self._maintenance_task = asyncio.create_task(self._run_maintenance())
+    
+    async def close(self):
+        """Финальная компакция при остановке"""
+        if self._maintenance_task is not None:
+            # Не отменяем задачу: прерванная компакция продолжила бы писать
+            # снимок в своем потоке одновременно с финальной
+            self._stopping = True
+            self._wakeup.set()
+            await self._maintenance_task
+            self._maintenance_task = None
+        if self.journal is not None:
+            try:
+                await self.compact()
+            except Exception as e:
+                logger.error("Ошибка компакции журнала БД: %s", e)
+            self.journal.close()
+    
+    def get(self, key):
+        return self.db.get(key)
+    
+    def insert(self, key, record):
+        self.db[key] = record
+        self._persist(key, record)
+    
+    def update(self, key, updates):
+        self.db[key].update(updates)
+        self._persist(key, updates)
+    
+    def update_many(self, items):
+        """Пакетное изменение: одна перезапись файла или одна пачка в журнале"""
+        self.write_batch((), items)
+    
+    def write_batch(self, inserts, updates):
+        """Новые записи и изменения одним коммитом"""
+        for key, record in inserts:
+            self.db[key] = record
+        for key, changes in updates:
+            self.db[key].update(changes)
+        if self.journal is None:
+            self.save_db()
+            return
+        for key, record in inserts:
+            self._persist(key, record)
+        for key, changes in updates:
+            self._persist(key, changes)
+    
+    def count(self):
+        return len(self.db)
+    
+    def iter_users(self):
+        return iter(list(self.db.values()))
+    
+    def active_premium_users(self, now_iso):
+        """Активные премиум пользователи (полный перебор)"""
+        return [
+            user for user in self.db.values()
+            if user.get("is_premium") and (not user.get("premium_expiry") or user["premium_expiry"] > now_iso)
+        ]
+    
+    def premium_expiries(self):
+        """(ключ, срок) всех премиум пользователей со сроком"""
+        return [
+            (key, user["premium_expiry"]) for key, user in self.db.items()
+            if user.get("is_premium") and user.get("premium_expiry")
+        ]
+    
+    def signal_total(self):
+        """Всего выдано сигналов (перебор при загрузке)"""
+        return sum(user.get("total_signals", 0) for user in self.db.values())
+    
+    def day_totals(self, day):
+        """Сигналы и активные пользователи за день (перебор при загрузке)"""
+        totals = {"signals": 0, "active_users": 0}
+        for user in self.db.values():
+            if user.get("quota_day") == day and user.get("signals_today"):
+                totals["signals"] += user["signals_today"]
+                totals["active_users"] += 1
+        return totals
+
+# Колонки таблицы users; остальные поля записи хранятся в JSON-колонке extra
+USER_COLUMNS = (
+    "id", "username", "is_premium", "premium_expiry", "premium_start",
+    "signals_today", "quota_day", "last_reset_date", "total_signals", "join_date", "last_pumpdump_check"
+)
+
+class SQLiteUserStore:
+    """Хранилище пользователей в SQLite (WAL, индексы по премиуму и квотам)"""
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            username TEXT,
+            is_premium INTEGER NOT NULL DEFAULT 0,
+            premium_expiry TEXT,
+            premium_start TEXT,
+            signals_today INTEGER NOT NULL DEFAULT 0,
+            quota_day INTEGER,
+            last_reset_date TEXT,
+            total_signals INTEGER NOT NULL DEFAULT 0,
+            join_date TEXT,
+            last_pumpdump_check TEXT,
+            extra TEXT
+        );
+    """
+    
+    INDEXES = """
+        CREATE INDEX IF NOT EXISTS idx_users_is_premium ON users(is_premium);
+        CREATE INDEX IF NOT EXISTS idx_users_premium_expiry ON users(premium_expiry);
+        DROP INDEX IF EXISTS idx_users_last_reset_date;
+        CREATE INDEX IF NOT EXISTS idx_users_quota_day ON users(quota_day);
+    """
+    
+    SELECT_USER = "SELECT * FROM users WHERE id = ?"
+    INSERT_USER = (
+        f"INSERT OR REPLACE INTO users ({', '.join(USER_COLUMNS)}, extra) "
+        f"VALUES ({', '.join('?' * (len(USER_COLUMNS) + 1))})"
+    )
+    INSERT_NEW_USER = (
+        f"INSERT OR IGNORE INTO users ({', '.join(USER_COLUMNS)}, extra) "
+        f"VALUES ({', '.join('?' * (len(USER_COLUMNS) + 1))})"
+    )
+    # Проверка лимита и списание одним запросом: между процессами нет гонки
+    CONSUME_QUOTA = (
+        "UPDATE users SET "
+        "signals_today = CASE WHEN quota_day = :day THEN signals_today + 1 ELSE 1 END, "
+        "quota_day = :day, total_signals = total_signals + 1 "
+        "WHERE id = :id AND (:unlimited OR quota_day IS NOT :day OR signals_today < :limit) "
+        "RETURNING signals_today, total_signals"
+    )
+    REFUND_QUOTA = (
+        "UPDATE users SET signals_today = MAX(0, signals_today - 1), "
+        "total_signals = MAX(0, total_signals - 1) "
+        "WHERE id = ? AND quota_day = ? AND signals_today > 0 "
+        "RETURNING signals_today, total_signals"
+    )
+    SELECT_ACTIVE_PREMIUM = (
+        "SELECT * FROM users WHERE is_premium = 1 "
+        "AND (premium_expiry IS NULL OR premium_expiry > ?)"
+    )
+    
+    # Счетчики для /stats при нескольких процессах-писателях: меняются
+    # триггерами в той же транзакции, что и запись пользователя. Внутри
+    # триггеров нет OR IGNORE: политику конфликтов подменил бы внешний
+    # INSERT OR REPLACE
+    AGGREGATES = """
+        CREATE TABLE IF NOT EXISTS user_totals (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS daily_totals (
+            day INTEGER PRIMARY KEY,
+            signals INTEGER NOT NULL DEFAULT 0,
+            active_users INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TRIGGER IF NOT EXISTS users_totals_insert AFTER INSERT ON users BEGIN
+            UPDATE user_totals SET value = value + CASE name
+                WHEN 'users' THEN 1
+                WHEN 'signals' THEN NEW.total_signals
+                WHEN 'premium' THEN NEW.is_premium END;
+            INSERT INTO daily_totals (day) SELECT NEW.quota_day WHERE NEW.quota_day IS NOT NULL
+                AND NOT EXISTS (SELECT 1 FROM daily_totals WHERE day = NEW.quota_day);
+            UPDATE daily_totals SET signals = signals + NEW.signals_today,
+                active_users = active_users + (NEW.signals_today > 0) WHERE day = NEW.quota_day;
+        END;
+        CREATE TRIGGER IF NOT EXISTS users_totals_delete AFTER DELETE ON users BEGIN
+            UPDATE user_totals SET value = value - CASE name
+                WHEN 'users' THEN 1
+                WHEN 'signals' THEN OLD.total_signals
+                WHEN 'premium' THEN OLD.is_premium END;
+            UPDATE daily_totals SET signals = signals - OLD.signals_today,
+                active_users = active_users - (OLD.signals_today > 0) WHERE day = OLD.quota_day;
+        END;
+        CREATE TRIGGER IF NOT EXISTS users_totals_update
+        AFTER UPDATE OF signals_today, quota_day, total_signals, is_premium ON users BEGIN
+            UPDATE user_totals SET value = value + CASE name
+                WHEN 'signals' THEN NEW.total_signals - OLD.total_signals
+                WHEN 'premium' THEN NEW.is_premium - OLD.is_premium
+                ELSE 0 END;
+            UPDATE daily_totals SET signals = signals - OLD.signals_today,
+                active_users = active_users - (OLD.signals_today > 0) WHERE day = OLD.quota_day;
+            INSERT INTO daily_totals (day) SELECT NEW.quota_day WHERE NEW.quota_day IS NOT NULL
+                AND NOT EXISTS (SELECT 1 FROM daily_totals WHERE day = NEW.quota_day);
+            UPDATE daily_totals SET signals = signals + NEW.signals_today,
+                active_users = active_users + (NEW.signals_today > 0) WHERE day = NEW.quota_day;
+        END;
+    """
+    # Начальные значения - только если счетчиков еще нет
+    BACKFILL_AGGREGATES = """
+        INSERT OR REPLACE INTO daily_totals (day, signals, active_users)
+            SELECT quota_day, SUM(signals_today), COUNT(*) FROM users
+            WHERE quota_day IS NOT NULL AND signals_today > 0
+            AND NOT EXISTS (SELECT 1 FROM user_totals) GROUP BY quota_day;
+        INSERT OR IGNORE INTO user_totals (name, value) VALUES
+            ('users', (SELECT COUNT(*) FROM users)),
+            ('signals', (SELECT COALESCE(SUM(total_signals), 0) FROM users)),
+            ('premium', (SELECT COUNT(*) FROM users WHERE is_premium = 1));
+    """
+    
+    def __init__(self, path=DB_SQLITE_FILE, auto_migrate=True):
+        self.path = path
+        # isolation_level=None: каждое изменение - отдельная короткая транзакция,
+        # пакетные операции открывают BEGIN явно.
+        # Скомпилированные запросы переиспользуются через кеш sqlite3 (cached_statements)
+        self.conn = sqlite3.connect(path, isolation_level=None, cached_statements=256, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.conn.executescript(self.SCHEMA)
+        self._upgrade_schema()
+        self.conn.executescript(self.INDEXES)
+        
+        if auto_migrate and self.count() == 0 and os.path.exists(DB_FILE):
+            migrate_json_to_sqlite(DB_FILE, self)
+    
+    def _upgrade_schema(self):
+        """Добавить колонки, появившиеся после создания базы"""
+        existing = {row["name"] for row in self.conn.execute("PRAGMA table_info(users)")}
+        if "quota_day" not in existing:
+            self.conn.execute("ALTER TABLE users ADD COLUMN quota_day INTEGER")
+        # Дата последнего сброса -> номер дня от 1970-01-01 (в том числе у записей,
+        # перенесенных из JSON без quota_day)
+        self.conn.execute(
+            "UPDATE users SET quota_day = CAST(julianday(last_reset_date) - 2440587.5 AS INTEGER) "
+            "WHERE quota_day IS NULL AND last_reset_date IS NOT NULL"
+        )
+    
+    @staticmethod
+    def _row_to_user(row):
+        user = {column: row[column] for column in USER_COLUMNS}
+        user["is_premium"] = bool(user["is_premium"])
+        if row["extra"]:
+            user.update(json.loads(row["extra"]))
+        return user
+    
+    @staticmethod
+    def _split_record(record):
+        """Разделить запись на значения колонок и JSON остальных полей"""
+        extra = {k: v for k, v in record.items() if k not in USER_COLUMNS}
+        values = [record.get(column) for column in USER_COLUMNS]
+        values[USER_COLUMNS.index("is_premium")] = int(bool(record.get("is_premium")))
+        # Иначе CONSUME_QUOTA сочтет день новым и обнулит счетчик
+        values[USER_COLUMNS.index("quota_day")] = record_quota_day(record)
+        values.append(json.dumps(extra, ensure_ascii=False) if extra else None)
+        return values
+    
+    def get(self, key):
+        row = self.conn.execute(self.SELECT_USER, (int(key),)).fetchone()
+        return self._row_to_user(row) if row else None
+    
+    def insert(self, key, record):
+        record = dict(record, id=int(key))
+        self.conn.execute(self.INSERT_USER, self._split_record(record))
+    
+    def insert_new(self, key, record):
+        """Вставить, только если записи еще нет. False - ее уже создал другой процесс"""
+        record = dict(record, id=int(key))
+        return self.conn.execute(self.INSERT_NEW_USER, self._split_record(record)).rowcount == 1
+    
+    def insert_many(self, records):
+        """Пакетная вставка в одной транзакции"""
+        self.write_batch(records, ())
+    
+    def update(self, key, updates):
+        self.conn.execute(*self._update_statement(key, updates))
+    
+    def update_many(self, items):
+        """Пакетное изменение в одной транзакции"""
+        self.write_batch((), items)
+    
+    def write_batch(self, inserts, updates):
+        """Новые записи и изменения в одной транзакции"""
+        # IMMEDIATE: блокировка записи берется сразу, а не при первом UPDATE -
+        # параллельный писатель ждет busy_timeout вместо ошибки "database is locked"
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.executemany(
+                self.INSERT_USER,
+                (self._split_record(dict(record, id=int(key))) for key, record in inserts)
+            )
+            for key, changes in updates:
+                self.conn.execute(*self._update_statement(key, changes))
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+    
+    @staticmethod
+    def _update_statement(key, updates):
+        columns = [k for k in updates if k in USER_COLUMNS and k != "id"]
+        extra = {k: v for k, v in updates.items() if k not in USER_COLUMNS}
+        assignments = [f"{column} = ?" for column in columns]
+        params = [int(bool(updates[c])) if c == "is_premium" else updates[c] for c in columns]
+        if extra:
+            assignments.append("extra = json_patch(coalesce(extra, '{}'), ?)")
+            params.append(json.dumps(extra, ensure_ascii=False))
+        if not assignments:
+            # Нечего менять - безопасный пустой запрос
+            assignments.append("id = id")
+        params.append(int(key))
+        # Имена колонок берутся только из USER_COLUMNS
+        return f"UPDATE users SET {', '.join(assignments)} WHERE id = ?", params
+    
+    def consume_quota(self, key, day, limit, unlimited):
+        """Списать сигнал, если лимит дня не исчерпан: (signals_today, total_signals) или None"""
+        row = self.conn.execute(
+            self.CONSUME_QUOTA, {"id": int(key), "day": day, "limit": limit, "unlimited": int(unlimited)}
+        ).fetchone()
+        return tuple(row) if row else None
+    
+    def refund_quota(self, key, day):
+        """Вернуть сигнал дня: (signals_today, total_signals) или None, если возвращать нечего"""
+        row = self.conn.execute(self.REFUND_QUOTA, (int(key), day)).fetchone()
+        return tuple(row) if row else None
+    
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    
+    def iter_users(self):
+        for row in self.conn.execute("SELECT * FROM users"):
+            yield self._row_to_user(row)
+    
+    def active_premium_users(self, now_iso):
+        """Активные премиум пользователи (по индексу)"""
+        return [self._row_to_user(row) for row in self.conn.execute(self.SELECT_ACTIVE_PREMIUM, (now_iso,))]
+    
+    def premium_expiries(self):
+        """(ключ, срок) всех премиум пользователей со сроком"""
+        rows = self.conn.execute(
+            "SELECT id, premium_expiry FROM users WHERE is_premium = 1 AND premium_expiry IS NOT NULL"
+        )
+        return [(str(user_id), expiry) for user_id, expiry in rows]
+    
+    def enable_aggregates(self):
+        """Включить счетчики на триггерах (один полный проход - только при первом включении)"""
+        # INSERT OR REPLACE удаляет старую строку - с recursive_triggers это видит триггер удаления
+        self.conn.execute("PRAGMA recursive_triggers=ON")
+        # Одна транзакция: процессы, стартующие одновременно, не заполнят счетчики дважды
+        try:
+            self.conn.executescript(f"BEGIN IMMEDIATE; {self.AGGREGATES} {self.BACKFILL_AGGREGATES} COMMIT;")
+        except sqlite3.Error:
+            if self.conn.in_transaction:
+                self.conn.execute("ROLLBACK")
+            raise
+    
+    def aggregates(self, day):
+        """Счетчики для /stats из таблиц триггеров (enable_aggregates)"""
+        totals = dict(self.conn.execute("SELECT name, value FROM user_totals"))
+        row = self.conn.execute("SELECT signals, active_users FROM daily_totals WHERE day = ?", (day,)).fetchone()
+        return {
+            "users": totals.get("users", 0),
+            "signals": totals.get("signals", 0),
+            "premium": totals.get("premium", 0),
+            "signals_today": row[0] if row else 0,
+            "active_today": row[1] if row else 0
+        }
+    
+    def prune_daily_totals(self, before_day):
+        self.conn.execute("DELETE FROM daily_totals WHERE day < ?", (before_day,))
+    
+    def premium_expiring(self, after_iso, until_iso):
+        """(ключ, срок) премиума со сроком в (after, until] - диапазон по индексу сроков"""
+        rows = self.conn.execute(
+            "SELECT id, premium_expiry FROM users WHERE premium_expiry > ? AND premium_expiry <= ? "
+            "AND is_premium = 1 ORDER BY premium_expiry", (after_iso, until_iso)
+        )
+        return [(str(user_id), expiry) for user_id, expiry in rows]
+    
+    def expire_due(self, now_iso, limit):
+        """Снять премиум с истекшим сроком; срок проверяется в той же транзакции,
+        поэтому продление из другого процесса не будет затерто"""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            keys = [row[0] for row in self.conn.execute(
+                "SELECT id FROM users WHERE premium_expiry <= ? AND is_premium = 1 LIMIT ?", (now_iso, limit)
+            )]
+            self.conn.executemany(
+                "UPDATE users SET is_premium = 0, premium_expiry = NULL WHERE id = ?", ((key,) for key in keys)
+            )
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return [str(key) for key in keys]
+    
+    def premium_ids(self, now_iso):
+        """id активных премиум пользователей (для рассылок)"""
+        rows = self.conn.execute(
+            "SELECT id FROM users WHERE is_premium = 1 AND (premium_expiry IS NULL OR premium_expiry > ?)",
+            (now_iso,)
+        )
+        return {user_id for user_id, in rows}
+    
+    def signal_total(self):
+        """Всего выдано сигналов"""
+        return self.conn.execute("SELECT COALESCE(SUM(total_signals), 0) FROM users").fetchone()[0]
+    
+    def day_totals(self, day):
+        """Сигналы и активные пользователи за день (по индексу quota_day)"""
+        count, signals = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(signals_today), 0) FROM users "
+            "WHERE quota_day = ? AND signals_today > 0", (day,)
+        ).fetchone()
+        return {"signals": signals, "active_users": count}
+    
+    def start_background(self):
+        pass
+    
+    async def close(self):
+        self.conn.close()
+
+def migrate_json_to_sqlite(json_path=DB_FILE, store=None):
+    """Одноразовый перенос users_db.json (с журналом) в SQLite"""
+    store = store or SQLiteUserStore(auto_migrate=False)
+    with open(json_path, 'r', encoding='utf-8') as f:
+        db = json.load(f)
+    UserJournal(DB_JOURNAL_FILE).replay(db)
+    store.insert_many(db.items())
+    expected = sum(1 for user in db.values() if record_quota_day(user) is not None)
+    migrated = store.conn.execute("SELECT COUNT(*) FROM users WHERE quota_day IS NOT NULL").fetchone()[0]
+    if migrated < expected:
+        raise RuntimeError(f"Перенос БД: день квоты не заполнен у {expected - migrated} пользователей")
+    logger.info("🗄 Перенесено пользователей из %s в %s: %s", json_path, store.path, len(db))
+    return len(db)
+
+def create_user_store():
+    """Хранилище по переменной окружения DB_BACKEND"""
+    if DB_BACKEND == "sqlite":
+        return SQLiteUserStore(DB_SQLITE_FILE)
+    return JsonUserStore(DB_WRITE_MODE)
+
+class PremiumExpiryIndex:
+    """Индекс сроков премиума: min-heap (timestamp, ключ) + текущий срок по ключу.
+    
+    Устаревшие элементы кучи (срок изменили или сняли) отбрасываются лениво
+    при извлечении.
+    """
+    
+    def __init__(self):
+        self._heap = []
+        self.deadlines = {}  # ключ -> timestamp окончания премиума
+    
+    def set(self, key, expiry_iso):
+        if not expiry_iso:
+            self.discard(key)
+            return
+        try:
+            deadline = datetime.fromisoformat(expiry_iso).timestamp()
+        except (TypeError, ValueError):
+            logger.error("Некорректный срок премиума у пользователя %s: %s", key, expiry_iso)
+            self.discard(key)
+            return
+        if self.deadlines.get(key) == deadline:
+            return
+        self.deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+        if len(self._heap) > 2 * len(self.deadlines) + 1024:
+            # Слишком много устаревших элементов - пересобираем кучу
+            self._heap = [(deadline, key) for key, deadline in self.deadlines.items()]
+            heapq.heapify(self._heap)
+    
+    def discard(self, key):
+        self.deadlines.pop(key, None)
+    
+    def deadline(self, key):
+        return self.deadlines.get(key)
+    
+    def pop_due(self, now, limit):
+        """Извлечь до limit ключей с истекшим сроком"""
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < limit:
+            deadline, key = heapq.heappop(self._heap)
+            if self.deadlines.get(key) == deadline:
+                del self.deadlines[key]
+                due.append(key)
+        return due
+    
+    def due_before(self, until):
+        """(timestamp, ключ) со сроком до until, по возрастанию - без обхода всей кучи"""
+        found = {}
+        stack = [0]
+        while stack:
+            i = stack.pop()
+            if i >= len(self._heap):
+                continue
+            deadline, key = self._heap[i]
+            if deadline > until:
+                continue  # у потомков срок еще позже
+            if self.deadlines.get(key) == deadline:
+                # После discard и повторного set с тем же сроком в куче
+                # два действующих элемента одного ключа - берем один
+                found[key] = deadline
+            stack.extend((2 * i + 1, 2 * i + 2))
+        return sorted((deadline, key) for key, deadline in found.items())
+    
+    def __len__(self):
+        return len(self.deadlines)
+
+class UserDatabase:
+    def __init__(self, store=None, shared=False):
+        self.store = store if store is not None else create_user_store()
+        # shared: в базу пишут несколько процессов - квоты списываются SQL-запросом,
+        # счетчики ведут триггеры SQLite, сроки премиума читаются по индексу базы
+        self.shared = shared
+        if shared:
+            self.store.enable_aggregates()
+        # Блокировки живут, пока их кто-то держит или ждет
+        self._locks = weakref.WeakValueDictionary()
+        self.reload_premium_index()
+        # Счетчики по дням: номер дня -> {"signals": ..., "active_users": ...}
+        today = current_day_epoch()
+        self.daily = {today: self.store.day_totals(today)}
+        # Общие счетчики: считаются один раз при загрузке, дальше меняются вместе с записями
+        self.totals = {"users": self.store.count(), "signals": self.store.signal_total()}
+    
+    def reload_premium_index(self):
+        """Индекс сроков и подписчики из хранилища"""
+        expiry_index = PremiumExpiryIndex()
+        for key, expiry in self.store.premium_expiries():
+            expiry_index.set(key, expiry)
+        self.expiry_index = expiry_index
+        # Подписчики для рассылок, без перебора всей базы
+        self.premium_subscribers = {
+            int(user["id"]) for user in self.store.active_premium_users(datetime.now().isoformat())
+        }
+    
+    def premium_deadline(self, key, user):
+        """Срок премиума как timestamp (None - бессрочно, ValueError - некорректный срок)"""
+        if not self.shared:
+            # Срок уже разобран индексом - без fromisoformat
+            deadline = self.expiry_index.deadline(key)
+            if deadline is not None:
+                return deadline
+        # В режиме shared индекс мог устареть: срок продлили в другом процессе
+        expiry = user.get("premium_expiry")
+        if not expiry:
+            return None
+        try:
+            return datetime.fromisoformat(expiry).timestamp()
+        except TypeError as e:
+            raise ValueError(str(e)) from e
+    
+    def record_daily(self, day, signals=0, active_users=0):
+        """Учесть сигналы и активных пользователей дня (O(1))"""
+        self.totals["signals"] += signals
+        totals = self.daily.get(day)
+        if totals is None:
+            totals = self.daily[day] = {"signals": 0, "active_users": 0}
+            for old_day in [d for d in self.daily if d <= day - DAILY_STATS_DAYS]:
+                del self.daily[old_day]
+        totals["signals"] += signals
+        totals["active_users"] += active_users
+    
+    def daily_stats(self, day=None):
+        """Счетчики за день (по умолчанию - сегодня)"""
+        day = current_day_epoch() if day is None else day
+        return dict(self.daily.get(day, {"signals": 0, "active_users": 0}))
+    
+    def lock(self, user_id):
+        """asyncio.Lock пользователя: сериализует его запросы, не мешая остальным"""
+        key = str(user_id)
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        return lock
+    
+    def start_background(self):
+        self.store.start_background()
+    
+    async def close(self):
+        await self.store.close()
+    
+    def premium_subscriber_ids(self):
+        """id подписчиков для рассылки"""
+        if self.shared:
+            # Премиум выдают и воркеры - список из индекса базы
+            return self.store.premium_ids(datetime.now().isoformat())
+        return self.premium_subscribers
+    
+    def get_active_premium_users(self):
+        """Все пользователи с действующим премиумом"""
+        return self.store.active_premium_users(datetime.now().isoformat())
+    
+    @staticmethod
+    def new_user(user_id):
+        """Запись нового пользователя"""
+        return {
+            "id": user_id,
+            "is_premium": False,
+            "premium_expiry": None,
+            "signals_today": 0,
+            "quota_day": current_day_epoch(),
+            "join_date": datetime.now().isoformat(),
+            "total_signals": 0,
+            "username": None,
+            "premium_start": None,
+            "last_pumpdump_check": None
+        }
+    
+    def get_user(self, user_id):
+        """Получить пользователя (создать если нет)"""
+        key = str(user_id)
+        user = self.store.get(key)
+        if user is None:
+            user = self.new_user(user_id)
+            if not self.shared:
+                self.store.insert(key, user)
+            elif not self.store.insert_new(key, user):
+                # Пользователя одновременно создал другой процесс
+                return self.store.get(key)
+            self.totals["users"] += 1
+        return user
+    
+    def update_user(self, user_id, updates):
+        """Обновить данные пользователя"""
+        key = str(user_id)
+        user = self.store.get(key)
+        if user is None:
+            user = self.get_user(user_id)
+        self.write_user(key, updates, {**user, **updates})
+    
+    def write_user(self, key, updates, user):
+        """Записать изменения; user - запись целиком после изменений (для индекса сроков)"""
+        self.store.update(key, updates)
+        if "is_premium" in updates or "premium_expiry" in updates:
+            if user.get("is_premium"):
+                self.expiry_index.set(key, user.get("premium_expiry"))
+                self.premium_subscribers.add(int(key))
+            else:
+                self.expiry_index.discard(key)
+                self.premium_subscribers.discard(int(key))
+    
+    def expire_due_premiums(self, limit=PREMIUM_SWEEP_BATCH):
+        """Снять премиум у всех, чей срок истек - одной пакетной записью"""
+        if self.shared:
+            # Сроки могли продлить в процессах-воркерах - проверяет сама база
+            keys = self.store.expire_due(datetime.now().isoformat(), limit)
+            self.store.prune_daily_totals(current_day_epoch() - DAILY_STATS_DAYS)
+        else:
+            keys = self.expiry_index.pop_due(time.time(), limit)
+            if keys:
+                self.store.update_many([(key, {"is_premium": False, "premium_expiry": None}) for key in keys])
+        if keys:
+            # В общем режиме expire_due уже записал изменения - обновляем только память
+            self.premium_subscribers.difference_update(int(key) for key in keys)
+            logger.info("⚠️ Премиум истек у пользователей: %s", len(keys))
+        return keys
+    
+    def activate_premium(self, grants):
+        """Выдать или продлить премиум списку (user_id, дни) одной пакетной записью.
+        
+        Действующая подписка продлевается от текущего срока, бессрочная
+        не меняется. Возвращает ([(user_id, срок или None)], новых пользователей).
+        """
+        days_by_user = {}
+        for user_id, days in grants:
+            days_by_user[user_id] = days_by_user.get(user_id, 0) + days
+        
+        now = datetime.now()
+        inserts, updates, activated = [], [], []
+        for user_id, days in days_by_user.items():
+            key = str(user_id)
+            user = self.store.get(key)
+            if user is not None and user.get("is_premium") and not user.get("premium_expiry"):
+                activated.append((user_id, None))
+                continue
+            
+            try:
+                deadline = self.premium_deadline(key, user) if user is not None else None
+            except ValueError:
+                deadline = None
+            active = user is not None and user.get("is_premium") and deadline and deadline > now.timestamp()
+            start = datetime.fromtimestamp(deadline) if active else now
+            changes = {"is_premium": True, "premium_expiry": (start + timedelta(days=days)).isoformat()}
+            if not active:
+                changes["premium_start"] = now.isoformat()
+            
+            if user is None:
+                inserts.append((key, {**self.new_user(user_id), **changes}))
+            else:
+                updates.append((key, changes))
+            activated.append((user_id, changes["premium_expiry"]))
+        
+        self.store.write_batch(inserts, updates)
+        self.totals["users"] += len(inserts)
+        for user_id, expiry in activated:
+            if expiry:
+                self.expiry_index.set(str(user_id), expiry)
+            self.premium_subscribers.add(user_id)
+        logger.info("💎 Премиум активирован: %s пользователей (новых: %s)", len(activated), len(inserts))
+        return activated, len(inserts)
+    
+    def stats(self):
+        """Сводка для /stats из поддерживаемых счетчиков (без обхода базы)"""
+        if self.shared:
+            # Другие процессы тоже пишут - счетчики из таблиц триггеров
+            totals = self.store.aggregates(current_day_epoch())
+            return {
+                "users": totals["users"],
+                "premium": totals["premium"],
+                "expiring_week": len(self.premium_expiring_within(PREMIUM_EXPIRING_STATS_DAYS * 86400)),
+                "signals_today": totals["signals_today"],
+                "active_today": totals["active_today"],
+                "signals_total": totals["signals"]
+            }
+        today = self.daily_stats()
+        return {
+            "users": self.totals["users"],
+            "premium": len(self.premium_subscribers),
+            "expiring_week": len(self.premium_expiring_within(PREMIUM_EXPIRING_STATS_DAYS * 86400)),
+            "signals_today": today["signals"],
+            "active_today": today["active_users"],
+            "signals_total": self.totals["signals"]
+        }
+    
+    def premium_expiring_within(self, seconds):
+        """(timestamp, ключ) подписок, истекающих в ближайшие seconds секунд"""
+        now = time.time()
+        if self.shared:
+            expiring = self.store.premium_expiring(
+                datetime.fromtimestamp(now).isoformat(), datetime.fromtimestamp(now + seconds).isoformat()
+            )
+            return [(datetime.fromisoformat(expiry).timestamp(), key) for key, expiry in expiring]
+        return [(deadline, key) for deadline, key in self.expiry_index.due_before(now + seconds) if deadline > now]
+    
+    def pending_premium_reminders(self, seconds):
+        """Пользователи, чья подписка истекает в ближайшие seconds секунд и кому еще не напоминали"""
+        pending = []
+        for _, key in self.premium_expiring_within(seconds):
+            user = self.store.get(key)
+            if user and user.get("premium_reminder_sent") != user.get("premium_expiry"):
+                pending.append(user)
+        return pending
+    
+    def mark_premium_reminded(self, users):
+        """Запомнить, к какому сроку отправлено напоминание"""
+        if users:
+            self.store.update_many([
+                (str(user["id"]), {"premium_reminder_sent": user["premium_expiry"]}) for user in users
+            ])
+    
+    @asynccontextmanager
+    async def session(self, user_id):
+        """Сессия пользователя на время обработчика: под блокировкой, один commit в конце"""
+        async with self.lock(user_id):
+            session = UserSession(self, user_id)
+            try:
+                yield session
+            finally:
+                session.commit()
+    
+    def consume_signal(self, user_id):
+        """Атомарно проверить дневной лимит и списать сигнал.
+        
+        Между проверкой и записью нет await, поэтому параллельные запросы
+        не могут оба пройти проверку лимита.
+        """
+        session = UserSession(self, user_id)
+        consumed = session.consume_signal()
+        session.commit()
+        return consumed
+    
+    def refund_signal(self, user_id):
+        """Вернуть списанный сигнал, если его не удалось отправить"""
+        session = UserSession(self, user_id)
+        session.refund_signal()
+        session.commit()
+
+class UserSession:
+    """Пользователь в рамках одного запроса.
+    
+    Запись читается один раз, срок премиума разбирается один раз,
+    все изменения копятся в памяти и сохраняются одним commit().
+    """
+    
+    def __init__(self, db, user_id):
+        self.db = db
+        self.user_id = user_id
+        self.key = str(user_id)
+        self.user = dict(db.get_user(user_id))
+        self.today = current_day_epoch()
+        self.changes = {}
+        self._signals_delta = 0
+        self._active_delta = 0
+        self._is_premium = None
+        self._expiry = None
+    
+    def update(self, **fields):
+        """Изменить поля (в памяти до commit)"""
+        self.user.update(fields)
+        self.changes.update(fields)
+    
+    @property
+    def is_premium(self):
+        if self._is_premium is None:
+            self._is_premium = self._check_premium()
+        return self._is_premium
+    
+    @property
+    def premium_expiry(self):
+        """Срок премиума как datetime (None - бессрочно или нет премиума)"""
+        if not self.is_premium:
+            return None
+        if self._expiry is None and self.user.get("premium_expiry"):
+            self._expiry = datetime.fromisoformat(self.user["premium_expiry"])
+        return self._expiry
+    
+    def _check_premium(self):
+        if not self.user.get("is_premium"):
+            return False
+        
+        if not self.user.get("premium_expiry"):
+            return True
+        
+        try:
+            deadline = self.db.premium_deadline(self.key, self.user)
+        except ValueError as e:
+            logger.error("Ошибка проверки срока премиума: %s", e)
+            return False
+        
+        # Срок истек, но фоновая задача еще не сняла премиум. В базу здесь
+        # не пишем: запись сессии перезаписала бы активацию, сделанную
+        # администратором, пока сессия ждала ответа
+        return time.time() <= deadline
+    
+    @property
+    def quota_day(self):
+        """День (номер от 1970-01-01), к которому относится signals_today"""
+        return record_quota_day(self.user)
+    
+    @property
+    def signals_today(self):
+        """Сигналов за сегодня: счетчик другого дня считается нулем без записи в БД"""
+        if self.quota_day != self.today:
+            return 0
+        return self.user.get("signals_today", 0)
+    
+    def can_send_signal(self):
+        return self.is_premium or self.signals_today < FREE_SIGNALS_PER_DAY
+    
+    def consume_signal(self):
+        """Проверить лимит и списать сигнал"""
+        if self.db.shared:
+            return self._consume_shared()
+        if not self.can_send_signal():
+            return False
+        if self.signals_today == 0:
+            self._active_delta += 1  # первый сигнал пользователя за день
+        self._signals_delta += 1
+        self.update(
+            signals_today=self.signals_today + 1,
+            total_signals=self.user.get("total_signals", 0) + 1,
+            quota_day=self.today
+        )
+        return True
+    
+    def _consume_shared(self):
+        """Списание одним UPDATE в базе: лимит соблюдается и между процессами"""
+        result = self.db.store.consume_quota(self.key, self.today, FREE_SIGNALS_PER_DAY, self.is_premium)
+        if result is None:
+            return False
+        self._sync_quota(result)
+        self._signals_delta += 1
+        if result[0] == 1:
+            self._active_delta += 1
+        return True
+    
+    def _sync_quota(self, result):
+        """Записанные базой счетчики - в запись сессии (без повторной записи в commit)"""
+        signals_today, total_signals = result
+        self.user.update(signals_today=signals_today, total_signals=total_signals, quota_day=self.today)
+        for field in ("signals_today", "total_signals", "quota_day"):
+            self.changes.pop(field, None)
+    
+    def refund_signal(self):
+        if self.db.shared:
+            result = self.db.store.refund_quota(self.key, self.today)
+            if result is not None:
+                self._sync_quota(result)
+                self._signals_delta -= 1
+                if result[0] == 0:
+                    self._active_delta -= 1
+            return
+        if self.signals_today:
+            self._signals_delta -= 1
+            if self.signals_today == 1:
+                self._active_delta -= 1
+        self.update(
+            signals_today=max(0, self.signals_today - 1),
+            total_signals=max(0, self.user.get("total_signals", 0) - 1)
+        )
+    
+    def stats(self):
+        return {
+            "is_premium": self.is_premium,
+            "signals_today": self.signals_today,
+            "total_signals": self.user.get("total_signals", 0),
+            "premium_expiry": self.user.get("premium_expiry"),
+            "username": self.user.get("username")
+        }
+    
+    def commit(self):
+        """Сохранить накопленные изменения одной записью"""
+        if self.changes:
+            self.db.write_user(self.key, self.changes, self.user)
+            self.changes = {}
+        if self._signals_delta or self._active_delta:
+            self.db.record_daily(self.today, self._signals_delta, self._active_delta)
+            self._signals_delta = self._active_delta = 0
+
+user_db = UserDatabase(shared=WORKERS > 1 and DB_BACKEND == "sqlite")
+
+# ================== КЕШ ==================
+class TTLCache:
+    """Кеш с ограничением размера (LRU), TTL на ключ и stale-while-revalidate.
+    
+    Время считается по монотонным часам, поэтому перевод системных часов
+    не влияет на срок жизни записей.
+    """
+    
+    FRESH = "fresh"  # можно отдавать как есть
+    STALE = "stale"  # можно отдать сразу, но нужно обновить в фоне
+    MISS = "miss"
+    
+    def __init__(self, max_size=1000, ttl=60, stale_ttl=600, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.clock = clock
+        self._data = OrderedDict()  # key -> (value, fresh_until, stale_until)
+        self.stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'evictions': 0}
+    
+    def get(self, key):
+        """Вернуть (значение, состояние)"""
+        entry = self._data.get(key)
+        if entry is None:
+            self.stats['misses'] += 1
+            return None, self.MISS
+        
+        value, fresh_until, stale_until = entry
+        now = self.clock()
+        if now >= stale_until:
+            del self._data[key]
+            self.stats['misses'] += 1
+            return None, self.MISS
+        
+        self._data.move_to_end(key)
+        if now < fresh_until:
+            self.stats['hits'] += 1
+            return value, self.FRESH
+        self.stats['stale_hits'] += 1
+        return value, self.STALE
+    
+    def set(self, key, value, ttl=None, stale_ttl=None):
+        """Записать значение. stale_ttl отсчитывается от момента записи"""
+        now = self.clock()
+        ttl = self.ttl if ttl is None else ttl
+        stale_ttl = self.stale_ttl if stale_ttl is None else stale_ttl
+        self._data[key] = (value, now + ttl, now + max(ttl, stale_ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.stats['evictions'] += 1
+    
+    def clear(self):
+        self._data.clear()
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def __contains__(self, key):
+        return key in self._data
+
+# ================== ЛИМИТЫ ЗАПРОСОВ К API ==================
+class CircuitOpenError(Exception):
+    """Circuit breaker открыт - запрос к API не отправляется"""
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity"""
+    
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = float(capacity)
+        self._updated = clock()
+        self._paused_until = 0.0
+    
+    def _refill(self):
+        now = self.clock()
+        if now < self._paused_until:
+            self._updated = now
+            return now
+        start = max(self._updated, self._paused_until)
+        self.tokens = min(self.capacity, self.tokens + (now - start) * self.rate)
+        self._updated = now
+        return now
+    
+    def try_acquire(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+    
+    def delay(self):
+        """Сколько секунд ждать до следующего токена"""
+        now = self._refill()
+        if now < self._paused_until:
+            return self._paused_until - now
+        return max(0.0, (1 - self.tokens) / self.rate)
+    
+    async def acquire(self):
+        while not self.try_acquire():
+            await asyncio.sleep(self.delay())
+    
+    def pause(self, seconds):
+        """Не выдавать токены seconds секунд (например, после 429)"""
+        self.tokens = 0.0
+        self._paused_until = max(self._paused_until, self.clock() + seconds)
+    
+    @property
+    def available(self):
+        self._refill()
+        return self.tokens
+
+class CircuitBreaker:
+    """Размыкается после серии ошибок, через reset_timeout пропускает один пробный запрос"""
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, failure_threshold=5, reset_timeout=60, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+    
+    def allow(self):
+        if self.state == self.OPEN:
+            if self.clock() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self._trial_in_flight = False
+        if self.state == self.HALF_OPEN:
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+        return True
+    
+    def release(self):
+        """Пробный запрос отменен, не дав результата"""
+        self._trial_in_flight = False
+    
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info("🔌 Circuit breaker CoinGecko замкнут")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._trial_in_flight = False
+    
+    def record_failure(self):
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning("🔌 Circuit breaker CoinGecko разомкнут после %s ошибок", self.failures)
+            self.state = self.OPEN
+            self.opened_at = self.clock()
+
+def parse_retry_after(value):
+    """Заголовок Retry-After: секунды или HTTP-дата"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class UpstreamScheduler:
+    """Планировщик запросов к CoinGecko: token bucket, backoff на 429/5xx и circuit breaker"""
+    
+    def __init__(self, rate_per_minute=COINGECKO_RATE_PER_MINUTE, burst=COINGECKO_BURST,
+                 max_retries=COINGECKO_MAX_RETRIES, breaker=None):
+        self.bucket = TokenBucket(rate_per_minute / 60.0, burst)
+        self.breaker = breaker or CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+        self.max_retries = max_retries
+        self.stats = {'requests': 0, 'throttled': 0, 'retries': 0, 'failures': 0, 'rejected': 0}
+    
+    @staticmethod
+    def backoff(attempt):
+        """Экспоненциальная задержка с полным jitter"""
+        return random.uniform(0, min(COINGECKO_BACKOFF_MAX, COINGECKO_BACKOFF_BASE * 2 ** attempt))
+    
+    async def request(self, send):
+        """Выполнить send() -> (status, data, retry_after) с учетом лимитов.
+        
+        Возвращает (status, data); при открытом breaker - CircuitOpenError.
+        """
+        status = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.stats['retries'] += 1
+            if not self.breaker.allow():
+                self.stats['rejected'] += 1
+                raise CircuitOpenError("CoinGecko circuit breaker is open")
+            
+            try:
+                await self.bucket.acquire()
+                self.stats['requests'] += 1
+                status, data, retry_after = await send()
+            except (asyncio.TimeoutError, aiohttp.ClientError):
+                self.stats['failures'] += 1
+                self.breaker.record_failure()
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self.backoff(attempt))
+                continue
+            except BaseException:
+                self.breaker.release()
+                raise
+            
+            if status == 429:
+                # Лимит превышен: ждем сколько просит API, остальные запросы тоже
+                self.stats['throttled'] += 1
+                self.breaker.release()
+                delay = retry_after if retry_after is not None else self.backoff(attempt)
+                self.bucket.pause(min(delay, COINGECKO_RETRY_AFTER_MAX))
+                logger.warning("🚦 CoinGecko 429, пауза %.1f сек", delay)
+                continue
+            
+            if status >= 500:
+                self.stats['failures'] += 1
+                self.breaker.record_failure()
+                if attempt < self.max_retries:
+                    await asyncio.sleep(self.backoff(attempt))
+                continue
+            
+            self.breaker.record_success()
+            return status, data
+        
+        return status, None
+    
+    def state(self):
+        """Состояние для мониторинга"""
+        return {
+            'tokens': round(self.bucket.available, 2),
+            'rate_per_minute': self.bucket.rate * 60,
+            'breaker': self.breaker.state,
+            'consecutive_failures': self.breaker.failures,
+            **self.stats
+        }
+
+# ================== РЕАЛЬНЫЕ ДАННЫЕ С COINGECKO ==================
+class CoinGeckoClient:
+    """Асинхронный клиент CoinGecko на aiohttp (не блокирует event loop)"""
+    
+    def __init__(self):
+        # Свежие данные - 60 секунд, после этого еще COINGECKO_STALE_TTL
+        # отдаем последнее значение и обновляем его в фоне
+        self.cache = TTLCache(
+            max_size=COINGECKO_CACHE_SIZE,
+            ttl=COINGECKO_CACHE_TTL,
+            stale_ttl=COINGECKO_STALE_TTL
+        )
+        self._session = None
+        self._background_tasks = set()
+        # Все запросы к API проходят через общий планировщик лимитов
+        self.scheduler = UpstreamScheduler()
+        # Запросы в полете: ключ -> общий Future (single-flight)
+        self._inflight = {}
+        # Последние реально полученные данные по монетам (резерв при сбоях API)
+        self.last_known = {}
+        self.stats = {
+            'upstream_requests': 0,  # реально отправленные запросы
+            'coalesced_requests': 0  # присоединились к уже идущему запросу
+        }
+    
+    async def get_session(self):
+        """Общая keep-alive сессия с пулом соединений"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=COINGECKO_POOL_SIZE,
+                keepalive_timeout=COINGECKO_KEEPALIVE,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=COINGECKO_TIMEOUT),
+                headers={'Accept': 'application/json'}
+            )
+        return self._session
+    
+    async def close(self):
+        """Закрыть сессию при остановке бота"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+    
+    async def _get_json(self, path, params):
+        """GET-запрос к CoinGecko через планировщик. Возвращает (status, json или None)"""
+        session = await self.get_session()
+        url = f"{COINGECKO_API_URL}{path}"
+        
+        async def send():
+            start = time.perf_counter()
+            status = 'error'
+            try:
+                async with session.get(url, params=params) as response:
+                    status = response.status
+                    if response.status != 200:
+                        return response.status, None, parse_retry_after(response.headers.get('Retry-After'))
+                    return response.status, await response.json(), None
+            finally:
+                COINGECKO_LATENCY.observe(time.perf_counter() - start, endpoint=path)
+                COINGECKO_RESPONSES.inc(endpoint=path, status=status)
+        
+        return await self.scheduler.request(send)
+    
+    async def _single_flight(self, key, fetch):
+        """Одновременные запросы с одним ключом ждут один общий запрос к API"""
+        future = self._inflight.get(key)
+        if future is not None:
+            self.stats['coalesced_requests'] += 1
+            # shield: отмена одного ожидающего не отменяет общий запрос
+            return await asyncio.shield(future)
+        
+        future = asyncio.ensure_future(fetch())
+        self._inflight[key] = future
+        self.stats['upstream_requests'] += 1
+        
+        def _done(f):
+            if self._inflight.get(key) is f:
+                del self._inflight[key]
+            if not f.cancelled():
+                f.exception()  # исключение уже доставлено ожидающим
+        
+        future.add_done_callback(_done)
+        return await asyncio.shield(future)
+    
+    async def get_coin_data(self, symbol):
+        """Получить реальные данные по монете с CoinGecko"""
+        coin_id = coin_registry.resolve(symbol)
+        if not coin_id:
+            logger.error("Неизвестный символ: %s", symbol)
+            return None
+        
+        # Проверяем кеш
+        cached_data, state = self.cache.get(f"{symbol}_data")
+        if state == TTLCache.FRESH:
+            return cached_data
+        if state == TTLCache.STALE:
+            # Отдаем последнее значение сразу, обновление идет в фоне
+            self._revalidate(symbol, coin_id)
+            return cached_data
+        
+        return await self._single_flight(('coin', coin_id), lambda: self._fetch_coin_data(symbol, coin_id))
+    
+    def _revalidate(self, symbol, coin_id):
+        """Фоновое обновление устаревшей записи (не больше одного на монету)"""
+        key = ('coin', coin_id)
+        if key in self._inflight:
+            return
+        task = asyncio.ensure_future(self._single_flight(key, lambda: self._fetch_coin_data(symbol, coin_id)))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+    
+    async def _fetch_coin_data(self, symbol, coin_id):
+        """Запрос одной монеты к API (вызывается через single-flight)"""
+        cache_key = f"{symbol}_data"
+        try:
+            # Делаем запрос к CoinGecko API
+            params = {
+                'ids': coin_id,
+                'vs_currencies': 'usd',
+                'include_24hr_change': 'true',
+                'include_last_updated_at': 'true'
+            }
+            
+            status, data = await self._get_json("/simple/price", params)
+            
+            if status == 200 and data and coin_id in data:
+                coin_data = data[coin_id]
+                
+                result = {
+                    'symbol': symbol,
+                    'price': coin_data.get('usd', 0),
+                    'change_24h': coin_data.get('usd_24h_change', 0),
+                    'last_updated': coin_data.get('last_updated_at', time.time()),
+                    'source': 'CoinGecko'
+                }
+                
+                # Сохраняем в кеш
+                self.cache.set(cache_key, result)
+                self.last_known[symbol] = result
+                
+                logger.info("✅ Получены реальные данные для %s: $%s (%s%%)",
+                            symbol, result['price'], result['change_24h'], extra=SAMPLED)
+                return result
+            
+            logger.warning("⚠️ CoinGecko API вернул %s для %s", status, symbol)
+            
+        except CircuitOpenError:
+            logger.warning("🔌 CoinGecko недоступен (circuit breaker), %s не запрошен", symbol)
+        except asyncio.TimeoutError:
+            logger.error("⏱️ Таймаут запроса к CoinGecko для %s", symbol)
+        except aiohttp.ClientError as e:
+            logger.error("❌ Ошибка запроса к CoinGecko: %s", e)
+        except Exception as e:
+            logger.error("❌ Неизвестная ошибка при запросе данных: %s", e)
+        
+        # Если API не работает, возвращаем последние полученные данные
+        return self.get_fallback_data(symbol)
+    
+    def get_fallback_data(self, symbol):
+        """Последние реально полученные данные (помечены как устаревшие) или None"""
+        FALLBACK_DATA.inc(symbol=symbol)
+        coin_data = self.last_known.get(symbol)
+        if coin_data is None:
+            logger.warning("⚠️ Нет сохраненных данных для %s", symbol)
+            return None
+        
+        logger.warning("⚠️ Используются последние сохраненные данные для %s", symbol)
+        return {**coin_data, 'source': 'Snapshot', 'stale': True}
+    
+    def prefill(self, snapshot):
+        """Заполнить кеш сохраненным снимком: записи сразу устаревшие,
+        поэтому отдаются мгновенно и обновляются в фоне при первом запросе"""
+        for symbol, coin_data in snapshot.coins.items():
+            self.last_known.setdefault(symbol, coin_data)
+            if f"{symbol}_data" not in self.cache:
+                self.cache.set(f"{symbol}_data", coin_data, ttl=0)
+    
+    async def get_multiple_coins(self, symbols):
+        """Получить данные для нескольких монет одним запросом"""
+        coin_ids = []
+        symbol_to_id = {}
+        
+        for symbol in symbols:
+            coin_id = coin_registry.resolve(symbol)
+            if coin_id:
+                coin_ids.append(coin_id)
+                symbol_to_id[coin_id] = symbol
+        
+        if not coin_ids:
+            return {}
+        
+        key = ('batch', tuple(sorted(coin_ids)))
+        return await self._single_flight(key, lambda: self._fetch_multiple_coins(coin_ids, symbol_to_id))
+    
+    async def _fetch_multiple_coins(self, coin_ids, symbol_to_id):
+        """Пакетный запрос к API (вызывается через single-flight)"""
+        try:
+            params = {
+                'ids': ','.join(coin_ids),
+                'vs_currencies': 'usd',
+                'include_24hr_change': 'true',
+                'include_last_updated_at': 'true'
+            }
+            
+            status, data = await self._get_json("/simple/price", params)
+            
+            if status == 200 and data:
+                results = {}
+                
+                for coin_id, coin_data in data.items():
+                    symbol = symbol_to_id.get(coin_id)
+                    if symbol:
+                        results[symbol] = {
+                            'symbol': symbol,
+                            'price': coin_data.get('usd', 0),
+                            'change_24h': coin_data.get('usd_24h_change', 0),
+                            'last_updated': coin_data.get('last_updated_at', time.time()),
+                            'source': 'CoinGecko'
+                        }
+                        # Пакетный ответ заодно обновляет кеш отдельных монет
+                        self.cache.set(f"{symbol}_data", results[symbol])
+                        self.last_known[symbol] = results[symbol]
+                
+                return results
+            
+            logger.warning("⚠️ CoinGecko API вернул %s для пакетного запроса", status)
+        
+        except CircuitOpenError:
+            logger.warning("🔌 CoinGecko недоступен (circuit breaker), пакетный запрос пропущен")
+        except asyncio.TimeoutError:
+            logger.error("⏱️ Таймаут пакетного запроса к CoinGecko")
+        except Exception as e:
+            logger.error("Ошибка получения множественных данных: %s", e)
+        
+        return {}
+
+    async def get_markets(self, top_n):
+        """Топ-N монет по капитализации (постранично через /coins/markets)"""
+        return await self._single_flight(('markets', top_n), lambda: self._fetch_markets(top_n))
+    
+    async def _fetch_markets(self, top_n):
+        rows = []
+        pages = -(-top_n // COINGECKO_MARKETS_PAGE_SIZE)
+        for page in range(1, pages + 1):
+            params = {
+                'vs_currency': 'usd',
+                'order': 'market_cap_desc',
+                'per_page': COINGECKO_MARKETS_PAGE_SIZE,
+                'page': page,
+                'price_change_percentage': '1h,24h',
+                'sparkline': 'false'
+            }
+            try:
+                status, data = await self._get_json("/coins/markets", params)
+            except CircuitOpenError:
+                logger.warning("🔌 CoinGecko недоступен (circuit breaker), /coins/markets пропущен")
+                break
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                logger.error("❌ Ошибка запроса /coins/markets (стр. %s): %s", page, e)
+                break
+            
+            if status != 200:
+                logger.warning("⚠️ CoinGecko API вернул %s для /coins/markets (стр. %s)", status, page)
+                break
+            if not data:
+                if rows:
+                    logger.info("📄 /coins/markets: рынков меньше запрошенного - %s из %s", len(rows), top_n)
+                else:
+                    logger.warning("⚠️ CoinGecko API вернул пустой список /coins/markets")
+                break
+            rows.extend(data)
+            if len(data) < COINGECKO_MARKETS_PAGE_SIZE:
+                if len(rows) < top_n:
+                    logger.info("📄 /coins/markets: неполная последняя страница %s - %s из %s", page, len(rows), top_n)
+                break
+        return rows[:top_n]
+
+coingecko_client = CoinGeckoClient()
+
+metrics.callback(
+    'coingecko_cache_lookups_total', 'Обращения к кешу CoinGecko по результату', 'counter',
+    lambda: {
+        ('hit',): coingecko_client.cache.stats['hits'],
+        ('stale',): coingecko_client.cache.stats['stale_hits'],
+        ('miss',): coingecko_client.cache.stats['misses']
+    },
+    ('result',)
+)
+metrics.callback(
+    'coingecko_cache_evictions_total', 'Вытеснения из кеша CoinGecko', 'counter',
+    lambda: coingecko_client.cache.stats['evictions']
+)
+metrics.callback(
+    'coingecko_cache_entries', 'Записей в кеше CoinGecko', 'gauge',
+    lambda: len(coingecko_client.cache)
+)
+metrics.callback(
+    'coingecko_coalesced_requests_total', 'Запросы, присоединенные к уже идущему запросу', 'counter',
+    lambda: coingecko_client.stats['coalesced_requests']
+)
+metrics.callback(
+    'coingecko_scheduler_events_total', 'События планировщика запросов CoinGecko', 'counter',
+    lambda: {(event,): value for event, value in coingecko_client.scheduler.stats.items()},
+    ('event',)
+)
+metrics.callback(
+    'coingecko_breaker_open', 'Circuit breaker CoinGecko разомкнут (1) или нет (0)', 'gauge',
+    lambda: int(coingecko_client.scheduler.breaker.state != CircuitBreaker.CLOSED)
+)
+
+# ================== РЕЕСТР МОНЕТ ==================
+class CoinRegistry:
+    """Все монеты CoinGecko: символ -> id за O(1) и готовые топ-N списки.
+    
+    Список /coins/list и ранги капитализации кешируются на диске и
+    обновляются раз в COIN_REGISTRY_TTL. Один символ часто носят десятки
+    токенов - выбирается монета с лучшим рангом, а монеты из COINGECKO_IDS
+    закреплены за своими символами всегда.
+    """
+    
+    def __init__(self, client, path=COIN_REGISTRY_FILE, ttl=COIN_REGISTRY_TTL, pinned=COINGECKO_IDS):
+        self.client = client
+        self.path = path
+        self.ttl = ttl
+        self.pinned = dict(pinned)
+        self.fetched_at = 0.0
+        self.by_symbol = dict(self.pinned)
+        self.tiers = {name: tuple(self.pinned)[:size] for name, size in SIGNAL_TIERS.items()}
+        self.loaded_mtime = None
+        self._task = None
+    
+    def resolve(self, symbol):
+        """id монеты CoinGecko по символу или None"""
+        return self.by_symbol.get(symbol.upper())
+    
+    def tier(self, name):
+        """Символы крупнейших монет снимка рынка (для случайного выбора сигналов)"""
+        return self.tiers[name]
+    
+    def _build(self, coins, ranks):
+        """Пересобрать индексы из [(id, символ)] и {id: ранг}"""
+        best = {}
+        for coin_id, symbol in coins:
+            symbol = symbol.upper()
+            rank = ranks.get(coin_id, float('inf'))
+            current = best.get(symbol)
+            if current is None or rank < current[0]:
+                best[symbol] = (rank, coin_id)
+        
+        by_symbol = {symbol: coin_id for symbol, (rank, coin_id) in best.items()}
+        by_symbol.update(self.pinned)
+        self.by_symbol = by_symbol
+        
+        # Сигналы берутся из снимка рынка, поэтому топы - среди монет снимка
+        universe = sorted(self.pinned, key=lambda symbol: ranks.get(self.pinned[symbol], float('inf')))
+        self.tiers = {name: tuple(universe[:size]) for name, size in SIGNAL_TIERS.items()}
+    
+    def load(self):
+        """Индексы из дискового кеша. False - кеша нет или он поврежден"""
+        if not os.path.exists(self.path):
+            return False
+        try:
+            mtime = os.path.getmtime(self.path)
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self._build(data['coins'], data['ranks'])
+            self.fetched_at = data['fetched_at']
+            self.loaded_mtime = mtime
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error("❌ Не удалось прочитать реестр монет: %s", e)
+            return False
+        logger.info("🪙 Реестр монет загружен с диска: %s символов", len(self.by_symbol))
+        return True
+    
+    def reload_if_changed(self):
+        """Перечитать дисковый кеш, если его обновил другой процесс"""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return False
+        return mtime != self.loaded_mtime and self.load()
+    
+    def _save(self, data):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+    
+    async def refresh(self):
+        """Загрузить /coins/list и ранги; при ошибке остаются прежние индексы"""
+        try:
+            status, listing = await self.client._get_json("/coins/list", {})
+        except (CircuitOpenError, asyncio.TimeoutError, aiohttp.ClientError) as e:
+            logger.warning("⚠️ Реестр монет не обновлен: %r", e)
+            return False
+        if status != 200 or not listing:
+            logger.warning("⚠️ CoinGecko API вернул %s для /coins/list", status)
+            return False
+        
+        markets = await self.client.get_markets(COIN_REGISTRY_RANKED)
+        ranks = {row['id']: rank for rank, row in enumerate(markets, start=1)}
+        coins = [(coin['id'], coin['symbol']) for coin in listing if coin.get('id') and coin.get('symbol')]
+        self._build(coins, ranks)
+        self.fetched_at = time.time()
+        await asyncio.to_thread(self._save, {'fetched_at': self.fetched_at, 'coins': coins, 'ranks': ranks})
+        logger.info("🪙 Реестр монет обновлен: %s монет, %s символов", len(coins), len(self.by_symbol))
+        return True
+    
+    async def _run(self):
+        while True:
+            age = time.time() - self.fetched_at
+            if age < self.ttl:
+                await asyncio.sleep(self.ttl - age)
+            try:
+                if not await self.refresh():
+                    # Повтор раньше срока, но не чаще раза в час
+                    self.fetched_at = time.time() - self.ttl + min(self.ttl, 3600)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("❌ Ошибка обновления реестра монет: %s", e)
+                self.fetched_at = time.time() - self.ttl + min(self.ttl, 3600)
+    
+    def start(self):
+        if self._task is None or self._task.done():
+            self.load()
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+coin_registry = CoinRegistry(coingecko_client)
+
+# ================== СНИМОК РЫНКА ==================
+@dataclass(frozen=True)
+class MarketSnapshot:
+    """Неизменяемый снимок цен всей вселенной монет"""
+    coins: MappingProxyType
+    fetched_at: float
+    version: int
+    
+    def get(self, symbol):
+        return self.coins.get(symbol)
+    
+    @property
+    def age(self):
+        """Возраст снимка в секундах"""
+        return time.time() - self.fetched_at
+
+EMPTY_SNAPSHOT = MarketSnapshot(MappingProxyType({}), 0.0, 0)
+
+SNAPSHOT_DTYPE = np.dtype([
+    ('symbol', 'U16'),
+    ('price', 'f8'),
+    ('change_24h', 'f8'),
+    ('last_updated', 'f8'),
+    ('fetched_at', 'f8')
+])
+
+# Строка разделяемого снимка: плюс признаки устаревших и восстановленных из файла данных
+SHARED_SNAPSHOT_DTYPE = np.dtype(SNAPSHOT_DTYPE.descr + [('stale', '?'), ('restored', '?')])
+
+def snapshot_to_rows(snapshot, dtype=SNAPSHOT_DTYPE):
+    """Снимок рынка -> структурированный массив numpy"""
+    with_stale = 'stale' in dtype.names
+    rows = []
+    for symbol, coin in snapshot.coins.items():
+        row = (symbol, coin['price'] or np.nan, coin['change_24h'] or 0.0,
+               coin.get('last_updated') or snapshot.fetched_at, snapshot.fetched_at)
+        if with_stale:
+            row += (bool(coin.get('stale')), coin.get('source') == 'Restored')
+        rows.append(row)
+    return np.array(rows, dtype=dtype)
+
+def snapshot_from_rows(rows, fetched_at, version, source=None):
+    """Структурированный массив -> снимок рынка.
+    
+    source задан - все монеты помечаются устаревшими с этим источником,
+    иначе признаки берутся из колонок stale и restored.
+    """
+    coins = {}
+    for row in rows:
+        if not np.isfinite(row['price']):
+            continue
+        symbol = str(row['symbol'])
+        stale = True if source else bool(row['stale'])
+        if not source and stale:
+            source_name = 'Restored' if row['restored'] else 'Snapshot'
+        else:
+            source_name = source or 'CoinGecko'
+        coins[symbol] = MappingProxyType({
+            'symbol': symbol,
+            'price': float(row['price']),
+            'change_24h': float(row['change_24h']),
+            'last_updated': float(row['last_updated']),
+            'source': source_name,
+            'stale': stale
+        })
+    return MarketSnapshot(MappingProxyType(coins), fetched_at, version)
+
+class SnapshotFile:
+    """Последний успешный снимок рынка на диске (структурированный .npy).
+    
+    Запись атомарная (tmp + fsync + rename), чтение через mmap. После
+    перезапуска бот отвечает наблюдавшимися ценами без запросов к API.
+    """
+    
+    def __init__(self, path=MARKET_SNAPSHOT_FILE):
+        self.path = path
+    
+    def save(self, snapshot):
+        rows = snapshot_to_rows(snapshot)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, rows)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+    
+    def load(self):
+        """Снимок из файла (все монеты помечены как восстановленные) или None"""
+        if not os.path.exists(self.path):
+            return None
+        try:
+            rows = np.load(self.path, mmap_mode='r')
+        except (OSError, ValueError) as e:
+            logger.error("❌ Не удалось прочитать сохраненный снимок рынка: %s", e)
+            return None
+        if rows.dtype != SNAPSHOT_DTYPE or not len(rows):
+            logger.warning("⚠️ Сохраненный снимок рынка в другом формате, пропускаем")
+            return None
+        # 'Restored', а не 'Snapshot': до первого опроса неизвестно, доступно ли API
+        return snapshot_from_rows(rows, float(rows['fetched_at'].max()), 0, source='Restored')
+
+SHARED_HEADER_DTYPE = np.dtype([
+    ('seq', 'i8'),  # нечетный - идет запись
+    ('published', 'i8'),  # номер публикации
+    ('version', 'i8'),
+    ('count', 'i8'),
+    ('fetched_at', 'f8')
+])
+
+class SharedSnapshotBuffer:
+    """Снимок рынка в разделяемой памяти: пишет главный процесс, читают воркеры.
+    
+    Заголовок и массив SHARED_SNAPSHOT_DTYPE лежат в одном блоке
+    shared_memory, numpy работает с ним напрямую без сериализации.
+    Согласованность - seqlock: на время записи seq нечетный, читатель
+    повторяет чтение, если seq нечетный или изменился за время чтения.
+    """
+    
+    def __init__(self, name=None, capacity=SHARED_SNAPSHOT_CAPACITY):
+        create = name is None
+        size = SHARED_HEADER_DTYPE.itemsize + capacity * SHARED_SNAPSHOT_DTYPE.itemsize
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=size if create else 0)
+        self.owner = create
+        self.header = np.ndarray((), dtype=SHARED_HEADER_DTYPE, buffer=self.shm.buf)
+        capacity = (self.shm.size - SHARED_HEADER_DTYPE.itemsize) // SHARED_SNAPSHOT_DTYPE.itemsize
+        self.rows = np.ndarray(
+            (capacity,), dtype=SHARED_SNAPSHOT_DTYPE, buffer=self.shm.buf, offset=SHARED_HEADER_DTYPE.itemsize
+        )
+        if create:
+            self.header[()] = (0, 0, 0, 0, 0.0)
+    
+    @property
+    def name(self):
+        return self.shm.name
+    
+    @property
+    def published(self):
+        """Номер последней публикации (0 - снимка еще нет)"""
+        return int(self.header['published'])
+    
+    def publish(self, snapshot):
+        """Записать снимок (только главный процесс, вызывается из одного потока)"""
+        rows = snapshot_to_rows(snapshot, SHARED_SNAPSHOT_DTYPE)[:len(self.rows)]
+        header = self.header
+        header['seq'] += 1
+        self.rows[:len(rows)] = rows
+        header['count'] = len(rows)
+        header['version'] = snapshot.version
+        header['fetched_at'] = snapshot.fetched_at
+        header['published'] += 1
+        header['seq'] += 1
+    
+    def read(self, retries=1000):
+        """(номер публикации, снимок) или None, если согласованно прочитать не удалось"""
+        header = self.header
+        for _ in range(retries):
+            seq = int(header['seq'])
+            if seq % 2:
+                time.sleep(0)
+                continue
+            published = int(header['published'])
+            version = int(header['version'])
+            fetched_at = float(header['fetched_at'])
+            rows = self.rows[:int(header['count'])].copy()
+            if int(header['seq']) == seq:
+                return published, snapshot_from_rows(rows, fetched_at, version)
+        return None
+    
+    def close(self):
+        # Представления numpy держат буфер - освобождаем их до закрытия
+        self.header = self.rows = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+class MarketDataPoller:
+    """Фоновая задача: один пакетный запрос на всю вселенную COINGECKO_IDS раз в интервал"""
+    
+    def __init__(self, client, symbols, interval=MARKET_POLL_INTERVAL, snapshot_file=None):
+        self.client = client
+        self.symbols = list(symbols)
+        self.interval = interval
+        self.snapshot_file = snapshot_file
+        self.snapshot = EMPTY_SNAPSHOT
+        self._task = None
+        self._listeners = []
+    
+    def add_listener(self, callback):
+        """callback(snapshot) вызывается после каждого успешного обновления"""
+        self._listeners.append(callback)
+    
+    async def refresh(self):
+        """Обновить снимок. При ошибке остается предыдущий"""
+        data = await self.client.get_multiple_coins(self.symbols)
+        if not data:
+            logger.warning("⚠️ Снимок рынка не обновлен, используется предыдущий")
+            self._mark_polled()
+            return False
+        
+        # Монеты, которых нет в ответе, берем из предыдущего снимка
+        coins = {symbol: self._polled(coin_data) for symbol, coin_data in self.snapshot.coins.items()}
+        for symbol, coin_data in data.items():
+            coins[symbol] = MappingProxyType(dict(coin_data))
+        
+        self.snapshot = MarketSnapshot(
+            coins=MappingProxyType(coins),
+            fetched_at=time.time(),
+            version=self.snapshot.version + 1
+        )
+        logger.info("📡 Снимок рынка #%s: %s монет", self.snapshot.version, len(data))
+        
+        self._notify()
+        if self.snapshot_file is not None:
+            try:
+                await asyncio.to_thread(self.snapshot_file.save, self.snapshot)
+            except Exception as e:
+                logger.error("❌ Ошибка сохранения снимка рынка: %s", e)
+        return True
+    
+    @staticmethod
+    def _polled(coin_data):
+        """Восстановленные из файла данные, которые API не обновило, - уже признак недоступности"""
+        if coin_data.get('source') != 'Restored':
+            return coin_data
+        return MappingProxyType({**coin_data, 'source': 'Snapshot'})
+    
+    def _mark_polled(self):
+        """Опрос не удался: восстановленный снимок теперь показывается как резервный"""
+        if not any(coin_data.get('source') == 'Restored' for coin_data in self.snapshot.coins.values()):
+            return
+        self.snapshot = MarketSnapshot(
+            coins=MappingProxyType({symbol: self._polled(coin_data) for symbol, coin_data in self.snapshot.coins.items()}),
+            fetched_at=self.snapshot.fetched_at,
+            version=self.snapshot.version + 1
+        )
+        self._notify()
+    
+    def _notify(self):
+        for callback in self._listeners:
+            try:
+                callback(self.snapshot)
+            except Exception as e:
+                logger.error("❌ Ошибка обработчика снимка рынка: %s", e)
+    
+    def warm_start(self):
+        """Загрузить сохраненный снимок до первого запроса к API"""
+        if self.snapshot_file is None or self.snapshot.coins:
+            return False
+        snapshot = self.snapshot_file.load()
+        if snapshot is None:
+            return False
+        self.snapshot = snapshot
+        self.client.prefill(snapshot)
+        self._notify()
+        logger.info("💾 Загружен сохраненный снимок рынка: %s монет, возраст %.0f мин",
+                    len(snapshot.coins), snapshot.age / 60)
+        return True
+    
+    async def _run(self):
+        if self.snapshot.coins and self.snapshot.age < self.interval:
+            # Сохраненный снимок еще свежий - первый запрос по расписанию
+            await asyncio.sleep(self.interval - self.snapshot.age)
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("❌ Ошибка обновления снимка рынка: %s", e)
+                self._mark_polled()
+            await asyncio.sleep(self.interval)
+    
+    async def _follow(self, buffer):
+        published = 0
+        while True:
+            try:
+                if buffer.published != published:
+                    result = buffer.read()
+                    if result is not None:
+                        published, self.snapshot = result
+                        # Последние цены для ответов при недоступности API
+                        self.client.last_known.update(self.snapshot.coins)
+                        self._notify()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("❌ Ошибка чтения разделяемого снимка рынка: %s", e)
+            await asyncio.sleep(SHARED_SNAPSHOT_POLL)
+    
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+    
+    def follow(self, buffer):
+        """Процесс-воркер: снимок из разделяемой памяти вместо запросов к API"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._follow(buffer))
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+market_poller = MarketDataPoller(coingecko_client, COINGECKO_IDS.keys(), snapshot_file=SnapshotFile())
+
+# ================== ИСТОРИЯ ЦЕН ==================
+class PriceHistory:
+    """Кольцевые буферы (время, цена) для фиксированного набора монет.
+    
+    Все монеты записываются одним срезом, поэтому шкала времени общая:
+    timestamps[capacity] и prices[capacity, монеты]. Память выделяется
+    один раз и не растет со временем работы.
+    """
+    
+    def __init__(self, symbols, capacity):
+        self.symbols = list(symbols)
+        self.index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self.capacity = capacity
+        self.timestamps = np.full(capacity, np.nan)
+        self.prices = np.full((capacity, len(self.symbols)), np.nan)
+        self.head = 0  # позиция следующей записи
+        self.size = 0
+    
+    def append_row(self, timestamp, row):
+        """Добавить срез цен (массив в порядке self.symbols) - O(1) по числу записей"""
+        self.timestamps[self.head] = timestamp
+        self.prices[self.head] = row
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+    
+    def append(self, timestamp, prices):
+        """Добавить срез цен {символ: цена}; отсутствующие монеты - NaN"""
+        row = np.full(len(self.symbols), np.nan)
+        for symbol, price in prices.items():
+            i = self.index.get(symbol)
+            if i is not None and price:
+                row[i] = price
+        self.append_row(timestamp, row)
+    
+    def _ordered(self):
+        """Индексы записей в хронологическом порядке"""
+        return np.arange(self.head - self.size, self.head) % self.capacity
+    
+    def window(self, seconds):
+        """(времена, цены) за последние seconds секунд"""
+        order = self._ordered()
+        timestamps = self.timestamps[order]
+        if not len(timestamps):
+            return timestamps, self.prices[order]
+        start = np.searchsorted(timestamps, timestamps[-1] - seconds, side='left')
+        return timestamps[start:], self.prices[order[start:]]
+    
+    def returns(self, seconds):
+        """Изменение цены в % за seconds секунд для всех монет (NaN - мало истории)"""
+        result = np.full(len(self.symbols), np.nan)
+        order = self._ordered()
+        if len(order) < 2:
+            return result
+        timestamps = self.timestamps[order]
+        # Последняя запись не позже, чем seconds секунд назад
+        base = np.searchsorted(timestamps, timestamps[-1] - seconds, side='right') - 1
+        if base < 0:
+            return result
+        start = self.prices[order[base]]
+        end = self.prices[order[-1]]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (end / start - 1.0) * 100.0
+    
+    def volatility(self, seconds, exclude_last=0):
+        """Стандартное отклонение лог-доходностей между соседними записями за окно.
+        
+        exclude_last - сколько последних записей не учитывать (чтобы проверяемое
+        движение не завышало собственную базу сравнения).
+        """
+        _, prices = self.window(seconds)
+        if exclude_last:
+            prices = prices[:-exclude_last]
+        if len(prices) < 3:
+            return np.full(len(self.symbols), np.nan)
+        with np.errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+            # Монеты без данных дают NaN - это ожидаемо
+            warnings.simplefilter('ignore', RuntimeWarning)
+            log_returns = np.diff(np.log(prices), axis=0)
+            valid = np.sum(~np.isnan(log_returns), axis=0)
+            volatility = np.nanstd(log_returns, axis=0, ddof=1)
+        volatility[valid < 2] = np.nan
+        return volatility
+    
+    def latest(self):
+        """Последний срез цен"""
+        if not self.size:
+            return np.full(len(self.symbols), np.nan)
+        return self.prices[(self.head - 1) % self.capacity]
+    
+    def reindexed(self, symbols):
+        """Копия истории для другого набора монет (общие монеты сохраняют данные)"""
+        history = PriceHistory(symbols, self.capacity)
+        history.timestamps[:] = self.timestamps
+        history.head = self.head
+        history.size = self.size
+        common = [(history.index[s], i) for s, i in self.index.items() if s in history.index]
+        if common:
+            dst, src = zip(*common)
+            history.prices[:, list(dst)] = self.prices[:, list(src)]
+        return history
+    
+    @property
+    def nbytes(self):
+        return self.timestamps.nbytes + self.prices.nbytes
+    
+    def summary(self, symbol):
+        """Доходности 5м/15м/1ч и волатильность за 1ч для одной монеты"""
+        i = self.index[symbol]
+        return {
+            'return_5m': float(self.returns(300)[i]),
+            'return_15m': float(self.returns(900)[i]),
+            'return_1h': float(self.returns(3600)[i]),
+            'volatility_1h': float(self.volatility(3600)[i])
+        }
+
+price_history = PriceHistory(
+    COINGECKO_IDS.keys(),
+    capacity=PRICE_HISTORY_SECONDS // MARKET_POLL_INTERVAL + 1
+)
+market_poller.add_listener(
+    lambda snapshot: price_history.append(
+        snapshot.fetched_at,
+        {symbol: coin['price'] for symbol, coin in snapshot.coins.items()}
+    )
+)
+
+# ================== СКАНЕР PUMP/DUMP ==================
+def robust_zscore(values):
+    """z-score через медиану и MAD (устойчив к выбросам)"""
+    finite = values[np.isfinite(values)]
+    if len(finite) < 3:
+        return np.full(len(values), np.nan)
+    median = np.median(finite)
+    mad = np.median(np.abs(finite - median)) * 1.4826
+    if not mad:
+        return np.full(len(values), np.nan)
+    return (values - median) / mad
+
+def _column(rows, field):
+    return np.fromiter(
+        (np.nan if row.get(field) is None else row[field] for row in rows),
+        dtype=float, count=len(rows)
+    )
+
+@dataclass(frozen=True)
+class MarketColumns:
+    """Рынок в колоночном виде: один массив на поле"""
+    ids: tuple
+    symbols: tuple
+    price: np.ndarray
+    change_1h: np.ndarray
+    change_24h: np.ndarray
+    volume: np.ndarray
+    market_cap: np.ndarray
+    fetched_at: float
+    
+    @classmethod
+    def from_markets(cls, rows, fetched_at):
+        """Из ответа /coins/markets"""
+        return cls(
+            ids=tuple(row['id'] for row in rows),
+            symbols=tuple(row['symbol'].upper() for row in rows),
+            price=_column(rows, 'current_price'),
+            change_1h=_column(rows, 'price_change_percentage_1h_in_currency'),
+            change_24h=_column(rows, 'price_change_percentage_24h'),
+            volume=_column(rows, 'total_volume'),
+            market_cap=_column(rows, 'market_cap'),
+            fetched_at=fetched_at
+        )
+    
+    @classmethod
+    def from_snapshot(cls, snapshot, history=None):
+        """Из снимка /simple/price (нет объемов); изменение за 1ч - из истории снимков"""
+        coins = list(snapshot.coins.values())
+        empty = np.full(len(coins), np.nan)
+        change_1h = empty
+        if history is not None and history.size >= 2:
+            returns = history.returns(3600)
+            change_1h = np.array([
+                returns[history.index[coin['symbol']]] if coin['symbol'] in history.index else np.nan
+                for coin in coins
+            ])
+        return cls(
+            ids=tuple(coin_registry.resolve(coin['symbol']) or coin['symbol'] for coin in coins),
+            symbols=tuple(coin['symbol'] for coin in coins),
+            price=_column(coins, 'price'),
+            change_1h=change_1h,
+            change_24h=_column(coins, 'change_24h'),
+            volume=empty,
+            market_cap=empty,
+            fetched_at=snapshot.fetched_at
+        )
     
-    def save_db(self):
+    def __len__(self):
+        return len(self.ids)
+
+@dataclass(frozen=True)
+class ScanResult:
+    alerts: tuple
+    scanned: int
+    fetched_at: float
+
+EMPTY_SCAN = ScanResult(alerts=(), scanned=0, fetched_at=0.0)
+
+class ScanResultFile:
+    """Результат сканера на диске: главный процесс пишет, воркеры перечитывают при изменении"""
+    
+    def __init__(self, path):
+        self.path = path
+        self.loaded_mtime = None
+    
+    def save(self, result):
+        data = {'alerts': list(result.alerts), 'scanned': result.scanned, 'fetched_at': result.fetched_at}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+    
+    def load_if_changed(self):
+        """Новый ScanResult или None, если файл не менялся"""
         try:
-            with open(DB_FILE, 'w', encoding='utf-8') as f:
-                json.dump(self.db, f, indent=2, ensure_ascii=False)
-        except Exception as e:
-            logger.error(f"Ошибка сохранения БД: {e}")
+            mtime = os.path.getmtime(self.path)
+            if mtime == self.loaded_mtime:
+                return None
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        self.loaded_mtime = mtime
+        return ScanResult(alerts=tuple(data['alerts']), scanned=data['scanned'], fetched_at=data['fetched_at'])
+
+class PumpDumpScanner:
+    """Периодический векторный поиск pump/dump по топ-N монет с CoinGecko"""
     
-    def get_user(self, user_id):
-        """Получить пользователя (создать если нет)"""
-        key = str(user_id)
-        if key not in self.db:
-            self.db[key] = {
-                "id": user_id,
-                "is_premium": False,
-                "premium_expiry": None,
-                "signals_today": 0,
-                "last_reset_date": datetime.now().date().isoformat(),
-                "join_date": datetime.now().isoformat(),
-                "total_signals": 0,
-                "username": None,
-                "premium_start": None,
-                "last_pumpdump_check": None
-            }
-            self.save_db()
-        return self.db[key]
+    def __init__(self, client, top_n=PUMPDUMP_TOP_N, interval=PUMPDUMP_SCAN_INTERVAL):
+        self.client = client
+        self.top_n = top_n
+        self.interval = interval
+        capacity = PUMPDUMP_HISTORY_SECONDS // interval + 1
+        # История по id монет: цены и объемы для трейлинговой волатильности
+        self.prices = PriceHistory([], capacity)
+        self.volumes = PriceHistory([], capacity)
+        self.result = EMPTY_SCAN
+        self._task = None
+        self._listeners = []
     
-    def update_user(self, user_id, updates):
-        """Обновить данные пользователя"""
-        key = str(user_id)
-        if key not in self.db:
-            self.get_user(user_id)
-        self.db[key].update(updates)
-        self.save_db()
+    def add_listener(self, callback):
+        """callback(result) вызывается после каждого успешного сканирования"""
+        self._listeners.append(callback)
     
-    def check_premium_status(self, user_id):
-        """ЕДИНАЯ ФУНКЦИЯ ПРОВЕРКИ ПРЕМИУМ СТАТУСА"""
-        user = self.get_user(user_id)
-        
-        if not user.get("is_premium"):
+    async def scan(self):
+        rows = await self.client.get_markets(self.top_n)
+        if not rows:
+            logger.warning("⚠️ Сканер pump/dump: нет данных рынка")
             return False
+        columns = MarketColumns.from_markets(rows, time.time())
+        self.record(columns)
+        self.result = self.evaluate(columns)
+        logger.info("🔍 Сканер pump/dump: %s монет, алертов %s", len(columns), len(self.result.alerts))
         
-        expiry = user.get("premium_expiry")
-        if expiry:
+        for callback in self._listeners:
             try:
-                expiry_date = datetime.fromisoformat(expiry)
-                if datetime.now() > expiry_date:
-                    self.update_user(user_id, {
-                        "is_premium": False,
-                        "premium_expiry": None
-                    })
-                    logger.info(f"⚠️ Премиум истек у пользователя {user_id}")
-                    return False
-                return True
+                callback(self.result)
             except Exception as e:
-                logger.error(f"Ошибка проверки срока премиума: {e}")
-                return False
-        
+                logger.error("❌ Ошибка обработчика сканера: %s", e)
         return True
     
-    def can_send_signal(self, user_id):
-        """Может ли пользователь получить сигнал"""
-        if self.check_premium_status(user_id):
-            return True
-        
-        user = self.get_user(user_id)
-        today = datetime.now().date().isoformat()
+    def record(self, columns):
+        """Добавить срез в историю (при смене состава топа - переиндексировать)"""
+        if list(columns.ids) != self.prices.symbols:
+            self.prices = self.prices.reindexed(columns.ids)
+            self.volumes = self.volumes.reindexed(columns.ids)
+        self.prices.append_row(columns.fetched_at, columns.price)
+        self.volumes.append_row(columns.fetched_at, columns.volume)
+    
+    def evaluate(self, columns, use_history=True):
+        """Оценка аномалий по всем монетам за один векторный проход"""
+        nan = np.full(len(columns), np.nan)
+        return_z = volume_z = nan
+        change_1h = columns.change_1h
         
-        if user.get("last_reset_date") != today:
-            self.update_user(user_id, {
-                "signals_today": 0,
-                "last_reset_date": today
-            })
-            return True
+        with np.errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            if use_history and self.prices.size >= 3:
+                # Доходность за 1ч против трейлинговой волатильности до этого часа, приведенной к 1ч
+                change_1h = np.where(np.isnan(change_1h), self.prices.returns(3600), change_1h)
+                last_hour = max(1, 3600 // self.interval)
+                volatility_1h = (
+                    self.prices.volatility(PUMPDUMP_VOLATILITY_WINDOW, exclude_last=last_hour)
+                    * np.sqrt(3600 / self.interval)
+                )
+                return_z = np.log1p(change_1h / 100) / volatility_1h
+                
+                # Текущий объем против среднего за окно (без последнего среза)
+                _, volumes = self.volumes.window(PUMPDUMP_VOLATILITY_WINDOW)
+                past = np.log(volumes[:-1])
+                volume_z = (np.log(columns.volume) - np.nanmean(past, axis=0)) / np.nanstd(past, axis=0, ddof=1)
+            
+            # Мало истории - сравниваем монеты между собой
+            return_z = np.where(np.isfinite(return_z), return_z, robust_zscore(change_1h))
+            volume_z = np.where(
+                np.isfinite(volume_z), volume_z,
+                robust_zscore(np.log(columns.volume / columns.market_cap))
+            )
+            
+            by_24h = np.abs(columns.change_24h) > PUMPDUMP_CHANGE_THRESHOLD
+            by_z = np.abs(return_z) >= PUMPDUMP_Z_THRESHOLD
+            # 24ч критерий на пороге приравнивается к PUMPDUMP_Z_THRESHOLD
+            score = np.fmax(
+                np.abs(return_z) + 0.5 * np.clip(volume_z, 0, None),
+                np.abs(columns.change_24h) / PUMPDUMP_CHANGE_THRESHOLD * PUMPDUMP_Z_THRESHOLD
+            )
+            score = np.nan_to_num(score)
+            
+            flagged = np.flatnonzero(by_24h | by_z)
+            top = flagged[np.argsort(-score[flagged], kind='stable')][:PUMPDUMP_MAX_ALERTS]
         
-        return user.get("signals_today", 0) < 1
+        alerts = tuple(
+            self._make_alert(columns, i, change_1h[i], return_z[i], volume_z[i], score[i], by_24h[i])
+            for i in top
+        )
+        return ScanResult(alerts=alerts, scanned=len(columns), fetched_at=columns.fetched_at)
     
-    def increment_signal_count(self, user_id):
-        """Увеличить счетчик сигналов"""
-        user = self.get_user(user_id)
-        signals_today = user.get("signals_today", 0) + 1
-        total_signals = user.get("total_signals", 0) + 1
+    @staticmethod
+    def _make_alert(columns, i, change_1h, return_z, volume_z, score, by_24h):
+        change = float(columns.change_24h[i])
+        if by_24h:
+            move = change
+            strong = abs(change) > 18
+            extreme = abs(change) > 20
+            window = '24h'
+            reason = f"изменение цены на {abs(change):.1f}% за 24 часа"
+        else:
+            move = float(change_1h)
+            strong = extreme = abs(return_z) >= PUMPDUMP_Z_STRONG
+            window = '1h'
+            reason = f"движение {move:+.1f}% за 1 час ({abs(return_z):.1f}σ от обычной волатильности)"
+        if np.isfinite(volume_z) and volume_z >= 2:
+            reason += ", объем выше нормы"
         
-        self.update_user(user_id, {
-            "signals_today": signals_today,
-            "total_signals": total_signals
-        })
-    
-    def get_user_stats(self, user_id):
-        """Получить статистику пользователя"""
-        user = self.get_user(user_id)
-        is_premium = self.check_premium_status(user_id)
+        if move > 0:
+            alert_type = "🚀 PUMP"
+            intensity = "🔥 СИЛЬНЫЙ" if strong else "📈 УМЕРЕННЫЙ"
+            action = "SELL" if extreme else "CAUTIOUS BUY"
+        else:
+            alert_type = "🔻 DUMP"
+            intensity = "💥 СИЛЬНЫЙ" if strong else "📉 УМЕРЕННЫЙ"
+            action = "BUY" if extreme else "WAIT"
         
         return {
-            "is_premium": is_premium,
-            "signals_today": user.get("signals_today", 0),
-            "total_signals": user.get("total_signals", 0),
-            "premium_expiry": user.get("premium_expiry"),
-            "username": user.get("username")
+            'symbol': columns.symbols[i],
+            'coin_id': columns.ids[i],
+            'type': alert_type,
+            'change': change,
+            'change_1h': float(change_1h),
+            'price': float(columns.price[i]),
+            'intensity': intensity,
+            'action': action,
+            'score': float(score),
+            'window': window,
+            'reason': reason
         }
+    
+    async def _run(self):
+        while True:
+            try:
+                await self.scan()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("❌ Ошибка сканера pump/dump: %s", e)
+            await asyncio.sleep(self.interval)
+    
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
 
-user_db = UserDatabase()
+pumpdump_scanner = PumpDumpScanner(coingecko_client)
 
-# ================== РЕАЛЬНЫЕ ДАННЫЕ С COINGECKO ==================
-class CoinGeckoClient:
-    """Класс для получения реальных данных с CoinGecko"""
+def get_market_data(symbol):
+    """Данные монеты из текущего снимка (без обращения к API)"""
+    coin_data = market_poller.snapshot.get(symbol)
+    if coin_data is None:
+        # Снимок еще не загружен
+        return coingecko_client.get_fallback_data(symbol)
+    return coin_data
+
+# ================== ОТПРАВКА СООБЩЕНИЙ ==================
+# Очереди с приоритетом: ответы пользователям идут раньше рассылок
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BROADCAST = 1
+LANE_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_BROADCAST: 'broadcast'}
+
+class OutboundMessage:
+    __slots__ = ('chat_id', 'text', 'kwargs', 'priority', 'future', 'enqueued_at', 'attempts')
     
-    def __init__(self):
-        self.cache = {}
-        self.cache_timeout = 60  # кешируем данные на 60 секунд
+    def __init__(self, chat_id, text, kwargs, priority, future):
+        self.chat_id = chat_id
+        self.text = text
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+class OutboundSender:
+    """Центральная отправка сообщений с учетом лимитов Telegram.
     
-    def get_coin_data(self, symbol):
-        """Получить реальные данные по монете с CoinGecko"""
-        coin_id = COINGECKO_IDS.get(symbol)
-        if not coin_id:
-            logger.error(f"Неизвестный символ: {symbol}")
-            return None
-        
-        # Проверяем кеш
-        cache_key = f"{symbol}_data"
-        if cache_key in self.cache:
-            cached_data, timestamp = self.cache[cache_key]
-            if (datetime.now() - timestamp).seconds < self.cache_timeout:
-                return cached_data
-        
-        try:
-            # Делаем запрос к CoinGecko API
-            url = f"{COINGECKO_API_URL}/simple/price"
-            params = {
-                'ids': coin_id,
-                'vs_currencies': 'usd',
-                'include_24hr_change': 'true',
-                'include_last_updated_at': 'true'
-            }
-            
-            response = requests.get(url, params=params, timeout=COINGECKO_TIMEOUT)
-            
-            if response.status_code == 200:
-                data = response.json()
-                
-                if coin_id in data:
-                    coin_data = data[coin_id]
-                    
-                    result = {
-                        'symbol': symbol,
-                        'price': coin_data.get('usd', 0),
-                        'change_24h': coin_data.get('usd_24h_change', 0),
-                        'last_updated': coin_data.get('last_updated_at', time.time()),
-                        'source': 'CoinGecko'
-                    }
-                    
-                    # Сохраняем в кеш
-                    self.cache[cache_key] = (result, datetime.now())
-                    
-                    logger.info(f"✅ Получены реальные данные для {symbol}: ${result['price']} ({result['change_24h']}%)")
-                    return result
-            
-            logger.warning(f"⚠️ CoinGecko API вернул {response.status_code} для {symbol}")
-            
-        except requests.exceptions.Timeout:
-            logger.error(f"⏱️ Таймаут запроса к CoinGecko для {symbol}")
-        except requests.exceptions.RequestException as e:
-            logger.error(f"❌ Ошибка запроса к CoinGecko: {e}")
-        except Exception as e:
-            logger.error(f"❌ Неизвестная ошибка при запросе данных: {e}")
-        
-        # Если API не работает, возвращаем реалистичные данные
-        return self.get_fallback_data(symbol)
+    Общий token bucket (~30 сообщений/сек) и отдельный на каждый чат (~1/сек
+    с небольшим запасом). Сообщение для чата, исчерпавшего лимит, откладывается
+    и не задерживает очередь для остальных. RetryAfter приостанавливает
+    отправку на указанное время, после чего сообщение отправляется повторно.
+    """
     
-    def get_fallback_data(self, symbol):
-        """Резервные данные если API недоступно"""
-        realistic_prices = {
-            'BTC': random.uniform(60000, 70000),
-            'ETH': random.uniform(3000, 4000),
-            'BNB': random.uniform(500, 600),
-            'SOL': random.uniform(100, 150),
-            'XRP': random.uniform(0.5, 0.7),
-            'ADA': random.uniform(0.4, 0.6),
-            'DOGE': random.uniform(0.1, 0.15),
-            'DOT': random.uniform(7, 9),
-            'MATIC': random.uniform(0.8, 1.0),
-            'LINK': random.uniform(14, 18)
-        }
-        
-        price = realistic_prices.get(symbol, random.uniform(1, 100))
-        change = random.uniform(-5, 5)
-        
-        result = {
-            'symbol': symbol,
-            'price': price,
-            'change_24h': change,
-            'last_updated': time.time(),
-            'source': 'Fallback'
-        }
-        
-        logger.warning(f"⚠️ Используются резервные данные для {symbol}")
-        return result
+    def __init__(self, rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE,
+                 chat_burst=TELEGRAM_CHAT_BURST, concurrency=TELEGRAM_SEND_CONCURRENCY):
+        self.bucket = TokenBucket(rate, rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._chat_buckets = {}
+        self._queue = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._slots = asyncio.Semaphore(concurrency)
+        self._bot = None
+        self._task = None
+        self._deliveries = set()  # ссылки на задачи отправки, чтобы их не собрал GC
+        self.depth = {lane: 0 for lane in LANE_NAMES}  # ждут в очереди (включая отложенные)
+        self.wait_times = {lane: deque(maxlen=1000) for lane in LANE_NAMES}  # секунды в очереди
+        self.stats = {'sent': 0, 'failed': 0, 'retry_after': 0, 'deferred': 0}
     
-    def get_multiple_coins(self, symbols):
-        """Получить данные для нескольких монет одновременно"""
-        coin_ids = []
-        symbol_to_id = {}
-        
-        for symbol in symbols:
-            coin_id = COINGECKO_IDS.get(symbol)
-            if coin_id:
-                coin_ids.append(coin_id)
-                symbol_to_id[coin_id] = symbol
-        
-        if not coin_ids:
-            return {}
-        
+    def submit(self, chat_id, text, priority=PRIORITY_INTERACTIVE, **kwargs):
+        """Поставить сообщение в очередь; Future получит отправленное Message"""
+        future = asyncio.get_running_loop().create_future()
+        item = OutboundMessage(chat_id, text, kwargs, priority, future)
+        self.depth[priority] += 1
+        self._queue.put_nowait((priority, next(self._seq), item))
+        return future
+    
+    async def send(self, chat_id, text, priority=PRIORITY_INTERACTIVE, **kwargs):
+        """Отправить и дождаться результата"""
+        return await self.submit(chat_id, text, priority, **kwargs)
+    
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= TELEGRAM_CHAT_BUCKETS_MAX:
+                # Полные ведра ничего не ограничивают - их можно забыть
+                for key in [k for k, b in self._chat_buckets.items() if b.available >= b.capacity]:
+                    del self._chat_buckets[key]
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+    
+    def _requeue(self, seq, item):
+        self._queue.put_nowait((item.priority, seq, item))
+    
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            priority, seq, item = await self._queue.get()
+            chat_bucket = self._chat_bucket(item.chat_id)
+            if not chat_bucket.try_acquire():
+                # Лимит чата исчерпан - откладываем, не блокируя остальные чаты
+                self.stats['deferred'] += 1
+                loop.call_later(chat_bucket.delay(), self._requeue, seq, item)
+                continue
+            await self.bucket.acquire()
+            await self._slots.acquire()
+            task = asyncio.create_task(self._deliver(seq, item))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+    
+    async def _deliver(self, seq, item):
         try:
-            url = f"{COINGECKO_API_URL}/simple/price"
-            params = {
-                'ids': ','.join(coin_ids),
-                'vs_currencies': 'usd',
-                'include_24hr_change': 'true'
-            }
-            
-            response = requests.get(url, params=params, timeout=COINGECKO_TIMEOUT)
+            item.attempts += 1
+            try:
+                message = await self._bot.send_message(chat_id=item.chat_id, text=item.text, **item.kwargs)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                self.stats['retry_after'] += 1
+                self.bucket.pause(retry_after)
+                logger.warning("🚦 Telegram RetryAfter %s сек (чат %s)", retry_after, item.chat_id)
+                if item.attempts <= TELEGRAM_MAX_ATTEMPTS:
+                    self._requeue(seq, item)
+                    return
+                raise
             
-            if response.status_code == 200:
-                data = response.json()
-                results = {}
-                
-                for coin_id, coin_data in data.items():
-                    symbol = symbol_to_id.get(coin_id)
-                    if symbol:
-                        results[symbol] = {
-                            'symbol': symbol,
-                            'price': coin_data.get('usd', 0),
-                            'change_24h': coin_data.get('usd_24h_change', 0),
-                            'source': 'CoinGecko'
-                        }
-                
-                return results
-        
+            waited = time.monotonic() - item.enqueued_at
+            self.depth[item.priority] -= 1
+            self.wait_times[item.priority].append(waited)
+            OUTBOUND_WAIT.observe(waited, lane=LANE_NAMES[item.priority])
+            self.stats['sent'] += 1
+            if not item.future.done():
+                item.future.set_result(message)
         except Exception as e:
-            logger.error(f"Ошибка получения множественных данных: {e}")
-        
-        return {}
+            self.depth[item.priority] -= 1
+            self.stats['failed'] += 1
+            if not item.future.done():
+                item.future.set_exception(e)
+        finally:
+            self._slots.release()
+    
+    def start(self, bot):
+        self._bot = bot
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._dispatch())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    def state(self):
+        """Глубина очередей и время ожидания для мониторинга"""
+        state = {'queue_depth': {LANE_NAMES[lane]: depth for lane, depth in self.depth.items()}, **self.stats}
+        for lane, samples in self.wait_times.items():
+            ordered = sorted(samples)
+            name = LANE_NAMES[lane]
+            state[f'{name}_wait_p50'] = ordered[len(ordered) // 2] if ordered else 0.0
+            state[f'{name}_wait_p99'] = ordered[int(len(ordered) * 0.99)] if ordered else 0.0
+        return state
 
-coingecko_client = CoinGeckoClient()
+# В многопроцессном режиме каждый процесс (главный и воркеры) отправляет
+# свою долю общего лимита бота
+outbound = OutboundSender(rate=TELEGRAM_GLOBAL_RATE / (WORKERS + 1) if WORKERS > 1 else TELEGRAM_GLOBAL_RATE)
+
+metrics.callback(
+    'telegram_outbound_queue_depth', 'Сообщений в очереди отправки', 'gauge',
+    lambda: {(LANE_NAMES[lane],): depth for lane, depth in outbound.depth.items()},
+    ('lane',)
+)
+metrics.callback(
+    'telegram_outbound_events_total', 'Отправка сообщений: отправлено, ошибки, RetryAfter, отложено', 'counter',
+    lambda: {(event,): value for event, value in outbound.stats.items()},
+    ('event',)
+)
+
+async def reply(update: Update, text, reply_markup=None):
+    """Ответ пользователю через общую очередь (приоритет выше рассылок)"""
+    return await outbound.send(update.effective_chat.id, text, reply_markup=reply_markup)
 
 # ================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==================
+def is_admin(user_id):
+    return ADMIN_ID != 0 and str(user_id) == str(ADMIN_ID)
+
+# Клавиатуры неизменяемы, поэтому создаются один раз и переиспользуются
+MAIN_KEYBOARD_ROWS = [
+    [KeyboardButton("🎯 Сигналы"), KeyboardButton("📈 Pump/Dump")],
+    [KeyboardButton("💎 Подписка"), KeyboardButton("🆘 Поддержка")]
+]
+MAIN_KEYBOARD = ReplyKeyboardMarkup(MAIN_KEYBOARD_ROWS, resize_keyboard=True)
+ADMIN_KEYBOARD = ReplyKeyboardMarkup(MAIN_KEYBOARD_ROWS + [[KeyboardButton("👑 Админ")]], resize_keyboard=True)
+
+PREMIUM_INLINE_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📤 Отправить чек", url="https://t.me/YESsignals_support_bot")],
+    [InlineKeyboardButton("🆘 Поддержка", callback_data="support")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="back")]
+])
+SUPPORT_INLINE_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🤖 Написать в поддержку", url="https://t.me/YESsignals_support_bot")],
+    [InlineKeyboardButton("💎 Оформить подписку", callback_data="subscription")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="back")]
+])
+
 def get_main_keyboard(user_id):
     """Главное меню"""
-    keyboard = [
-        [KeyboardButton("🎯 Сигналы"), KeyboardButton("📈 Pump/Dump")],
-        [KeyboardButton("💎 Подписка"), KeyboardButton("🆘 Поддержка")]
-    ]
-    
-    if str(user_id) == str(ADMIN_ID) and ADMIN_ID != 0:
-        keyboard.append([KeyboardButton("👑 Админ")])
-    
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    return ADMIN_KEYBOARD if is_admin(user_id) else MAIN_KEYBOARD
 
 def format_price(price):
     """Форматировать цену"""
@@ -327,28 +3179,41 @@ def format_price(price):
     else:
         return f"${price:.6f}"
 
-def generate_signal_from_real_data(coin_data):
+def format_change(change):
+    """Форматировать изменение в % (н/д если нет данных)"""
+    if change is None or change != change:  # NaN
+        return "н/д"
+    return f"{change:+.1f}%"
+
+def signal_rng(symbol, timestamp):
+    """Детерминированный генератор: один и тот же сигнал для одних и тех же данных"""
+    return random.Random(f"{symbol}:{timestamp}")
+
+def generate_signal_from_real_data(coin_data, rng=None):
     """Генерация сигнала на основе реальных данных"""
     symbol = coin_data['symbol']
     price = coin_data['price']
     change = coin_data['change_24h']
+    timestamp = coin_data.get('last_updated')
+    if rng is None:
+        rng = signal_rng(symbol, timestamp)
     
     # Логика на основе реальных изменений цены
     if change > 5:
         action = 'SELL'
-        target_percent = random.uniform(2, 6)
-        stop_loss_percent = random.uniform(1, 3)
-        confidence = random.randint(70, 85)
+        target_percent = rng.uniform(2, 6)
+        stop_loss_percent = rng.uniform(1, 3)
+        confidence = rng.randint(70, 85)
     elif change < -5:
         action = 'BUY'
-        target_percent = random.uniform(3, 7)
-        stop_loss_percent = random.uniform(1.5, 3.5)
-        confidence = random.randint(70, 85)
+        target_percent = rng.uniform(3, 7)
+        stop_loss_percent = rng.uniform(1.5, 3.5)
+        confidence = rng.randint(70, 85)
     else:
-        action = random.choice(['BUY', 'SELL'])
-        target_percent = random.uniform(2, 5)
-        stop_loss_percent = random.uniform(1, 2.5)
-        confidence = random.randint(60, 75)
+        action = rng.choice(['BUY', 'SELL'])
+        target_percent = rng.uniform(2, 5)
+        stop_loss_percent = rng.uniform(1, 2.5)
+        confidence = rng.randint(60, 75)
     
     # Расчет целей на основе реальной цены
     if action == 'BUY':
@@ -378,6 +3243,7 @@ def generate_signal_from_real_data(coin_data):
     
     return {
         'symbol': symbol,
+        'timestamp': timestamp,
         'action': action,
         'price': price,
         'change': change,
@@ -392,54 +3258,134 @@ def generate_signal_from_real_data(coin_data):
         'data_source': coin_data.get('source', 'Unknown')
     }
 
-# ================== КОМАНДЫ БОТА ==================
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда /start"""
-    user = update.effective_user
-    user_id = user.id
+def render_pumpdump_alert(alert, detected_at):
+    """Текст pump/dump алерта (один раз на алерт и время сканирования)"""
+    key = (alert['coin_id'], alert['window'], detected_at)
+    text = rendered_texts.get(key)
+    if text is None:
+        detected = datetime.fromtimestamp(detected_at or time.time()).strftime('%H:%M %d.%m.%Y')
+        text = rendered_texts.put(key, PUMPDUMP_ALERT.render(
+            type=alert['type'],
+            symbol=alert['symbol'],
+            price=format_price(alert['price']),
+            change=alert['change'],
+            change_1h=format_change(alert['change_1h']),
+            intensity=alert['intensity'],
+            action=alert['action'],
+            detected=detected,
+            reason=alert['reason']
+        ))
+    return text
+
+def render_signal(signal, is_premium, signals_today):
+    """Текст сигнала: тело считается один раз на сигнал, дальше только счетчик"""
+    key = (signal['symbol'], signal['timestamp'], signal['data_source'], is_premium)
+    body = rendered_texts.get(key)
+    if body is None:
+        template = PREMIUM_SIGNAL if is_premium else FREE_SIGNAL_HEAD
+        body = rendered_texts.put(key, template.render(**{
+            **signal,
+            'data_source': DATA_SOURCE_LABELS.get(signal['data_source'], DATA_SOURCE_LABELS['Snapshot']),
+            'trend': TREND_LABELS[(signal['change'] > 0) - (signal['change'] < 0)]
+        }))
+    if is_premium:
+        return body
+    return body + FREE_SIGNAL_TAIL.render(signals_today=signals_today)
+
+# ================== ШАБЛОНЫ СООБЩЕНИЙ ==================
+class MessageTemplate:
+    """Шаблон, разобранный один раз при загрузке.
     
-    user_db.update_user(user_id, {"username": user.username})
+    Текст хранится как статичные куски и подставляемые поля, render()
+    только форматирует поля и склеивает готовые строки. Поля из constants
+    подставляются сразу при разборе и становятся частью статичного текста.
+    """
     
-    stats = user_db.get_user_stats(user_id)
-    is_premium = stats["is_premium"]
+    def __init__(self, template, **constants):
+        self.literals = []
+        self.fields = []  # (имя, формат)
+        literal = []
+        for text, field, spec, conversion in string.Formatter().parse(template):
+            literal.append(text)
+            if field is None:
+                continue
+            if field in constants:
+                literal.append(format(constants[field], spec))
+                continue
+            self.literals.append(''.join(literal))
+            self.fields.append((field, spec))
+            literal = []
+        self.literals.append(''.join(literal))
     
-    text = f"""
-🚀 **Добро пожаловать в YESsignals_bot, {user.first_name}!**
+    def render(self, **values):
+        parts = [self.literals[0]]
+        for (field, spec), literal in zip(self.fields, self.literals[1:]):
+            parts.append(format(values[field], spec))
+            parts.append(literal)
+        return ''.join(parts)
+
+class RenderCache:
+    """Ограниченный LRU-кеш готовых текстов (сигналы и алерты)"""
+    
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0}
+    
+    def get(self, key):
+        text = self._data.get(key)
+        if text is None:
+            self.stats['misses'] += 1
+            return None
+        self._data.move_to_end(key)
+        self.stats['hits'] += 1
+        return text
+    
+    def put(self, key, text):
+        self._data[key] = text
+        if len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+        return text
+
+rendered_texts = RenderCache(RENDER_CACHE_SIZE)
+
+STATUS_LABELS = {True: '✅ ПРЕМИУМ', False: '🎯 БЕСПЛАТНЫЙ'}
+LIMIT_STATUS_LABELS = {True: '💎 ПРЕМИУМ', False: '🎯 БЕСПЛАТНЫЙ'}
+PUMPDUMP_ACCESS_LABELS = {True: '✅ доступен', False: '🔒 только для премиума'}
+PUMPDUMP_ROLE_LABELS = {True: '💎 **Ваш статус:** ПРЕМИУМ ✅', False: '👑 **Администратор**'}
+DATA_SOURCE_LABELS = {
+    'CoinGecko': "📊 **Реальные данные с бирж**",
+    'Snapshot': "⚠️ **Последние сохраненные данные (API недоступно)**",
+    'Restored': "💾 **Сохраненные данные (обновляются)**"
+}
+TREND_LABELS = {1: '📈 Восходящий', -1: '📉 Нисходящий', 0: '➡️ Боковой'}
+
+START_TEXT = MessageTemplate("""
+🚀 **Добро пожаловать в YESsignals_bot, {first_name}!**
 
 👤 **Ваш ID:** `{user_id}`
-💎 **Статус:** {'✅ ПРЕМИУМ' if is_premium else '🎯 БЕСПЛАТНЫЙ'}
+💎 **Статус:** {status}
 
 📊 **Статистика:**
-• Сигналов сегодня: {stats['signals_today']}/1
-• Всего сигналов: {stats['total_signals']}
+• Сигналов сегодня: {signals_today}/1
+• Всего сигналов: {total_signals}
 
 🔔 **Доступные функции:**
 • 🎯 1 бесплатный сигнал в день (реальные данные)
-• 📈 Pump/Dump мониторинг ({'✅ доступен' if is_premium else '🔒 только для премиума'})
+• 📈 Pump/Dump мониторинг ({pumpdump_access})
 • 💎 Премиум: неограниченные сигналы
 • 🆘 Поддержка 24/7
 
 💡 **Используйте кнопки меню для навигации!**
-"""
-    
-    await update.message.reply_text(text, reply_markup=get_main_keyboard(user_id))
+""")
 
-async def signals_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Получить торговые сигналы с реальными данными"""
-    user = update.effective_user
-    user_id = user.id
-    
-    # Проверяем может ли пользователь получить сигнал
-    if not user_db.can_send_signal(user_id):
-        stats = user_db.get_user_stats(user_id)
-        
-        text = f"""
+LIMIT_REACHED_TEXT = MessageTemplate("""
 ❌ **Достигнут дневной лимит!**
 
 📊 **Ваша статистика:**
-• Статус: {'💎 ПРЕМИУМ' if stats['is_premium'] else '🎯 БЕСПЛАТНЫЙ'}
-• Использовано сегодня: {stats['signals_today']}/1 сигналов
-• Всего сигналов: {stats['total_signals']}
+• Статус: {status}
+• Использовано сегодня: {signals_today}/1 сигналов
+• Всего сигналов: {total_signals}
 
 💎 **Премиум подписка включает:**
 • Неограниченные сигналы (сколько угодно в день)
@@ -449,120 +3395,56 @@ async def signals_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 💰 **Стоимость:** 9 USDT на 30 дней
 👉 /premium - оформить подписку
-"""
-        await update.message.reply_text(text, reply_markup=get_main_keyboard(user_id))
-        return
-    
-    # Показываем статус
-    stats = user_db.get_user_stats(user_id)
-    is_premium = stats["is_premium"]
-    
-    loading_msg = await update.message.reply_text(
-        "🔄 Запрашиваю реальные данные с бирж..." if is_premium else "🔄 Запрашиваю реальный бесплатный сигнал..."
-    )
-    
-    try:
-        # Выбираем монеты в зависимости от статуса
-        if is_premium:
-            # Для премиум: 3 разные монеты
-            symbols = random.sample(list(COINGECKO_IDS.keys())[:15], 3)
-        else:
-            # Для бесплатных: 1 монета из топ-10
-            symbols = [random.choice(list(COINGECKO_IDS.keys())[:10])]
-        
-        signals = []
-        for symbol in symbols:
-            # Получаем реальные данные
-            coin_data = coingecko_client.get_coin_data(symbol)
-            if coin_data:
-                # Генерируем сигнал на основе реальных данных
-                signal = generate_signal_from_real_data(coin_data)
-                signals.append(signal)
-        
-        await loading_msg.delete()
-        
-        if not signals:
-            await update.message.reply_text(
-                "⚠️ Временно не удалось получить данные с бирж. Попробуйте позже.",
-                reply_markup=get_main_keyboard(user_id)
-            )
-            return
-        
-        # Отправляем сигналы
-        for signal in signals:
-            data_source = "📊 **Реальные данные с бирж**" if signal.get('data_source') == 'CoinGecko' else "⚠️ **Оценочные данные (API недоступно)**"
-            
-            if is_premium:
-                text = f"""
+""")
+
+PREMIUM_SIGNAL = MessageTemplate("""
 💎 **ПРЕМИУМ СИГНАЛ** 💎
 {data_source}
 
-🏷 **Пара:** {signal['symbol']}/USDT
-⚡ **Действие:** {signal['action']}
-💰 **Текущая цена:** {signal['formatted_price']}
-📊 **Изменение 24ч:** {signal['change']:+.2f}%
-🎯 **Цель:** {signal['formatted_target']}
-🛑 **Стоп-лосс:** {signal['formatted_stop_loss']}
-📈 **Плечо:** {signal['leverage']}
-✅ **Уверенность:** {signal['confidence']}
+🏷 **Пара:** {symbol}/USDT
+⚡ **Действие:** {action}
+💰 **Текущая цена:** {formatted_price}
+📊 **Изменение 24ч:** {change:+.2f}%
+🎯 **Цель:** {formatted_target}
+🛑 **Стоп-лосс:** {formatted_stop_loss}
+📈 **Плечо:** {leverage}
+✅ **Уверенность:** {confidence}
 
-⏰ **Время обновления:** {signal['time']}
+⏰ **Время обновления:** {time}
 
 ⚠️ **Предупреждение о рисках:**
 Сигналы основаны на реальных данных с бирж.
 Проводите собственный анализ перед сделками.
-"""
-            else:
-                text = f"""
+""")
+
+FREE_SIGNAL_HEAD = MessageTemplate("""
 🎯 **БЕСПЛАТНЫЙ СИГНАЛ** 🎯
 {data_source}
 
-🏷 **Пара:** {signal['symbol']}/USDT
-💰 **Реальная цена:** {signal['formatted_price']}
-📊 **Изменение 24ч:** {signal['change']:+.2f}%
-📈 **Тренд:** {'📈 Восходящий' if signal['change'] > 0 else '📉 Нисходящий' if signal['change'] < 0 else '➡️ Боковой'}
+🏷 **Пара:** {symbol}/USDT
+💰 **Реальная цена:** {formatted_price}
+📊 **Изменение 24ч:** {change:+.2f}%
+📈 **Тренд:** {trend}
 
 🔒 **Для получения полных сигналов оформите премиум!**
 
-📊 **Использовано сегодня:** {stats['signals_today'] + 1}/1
+""")
+
+FREE_SIGNAL_TAIL = MessageTemplate("""📊 **Использовано сегодня:** {signals_today}/1
 💎 **Премиум:** /premium
 
 ⚠️ **Торговля сопряжена с рисками.**
-"""
-            
-            await update.message.reply_text(text, reply_markup=get_main_keyboard(user_id))
-            await asyncio.sleep(0.3)
-        
-        # Увеличиваем счетчик
-        user_db.increment_signal_count(user_id)
-        
-    except Exception as e:
-        logger.error(f"Ошибка получения сигналов: {e}")
-        await update.message.reply_text(
-            "⚠️ Ошибка получения данных. Попробуйте позже.",
-            reply_markup=get_main_keyboard(user_id)
-        )
+""")
 
-async def pumpdump_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Pump/Dump мониторинг с реальными данными"""
-    user = update.effective_user
-    user_id = user.id
-    
-    # СТРОГАЯ проверка премиум статуса
-    stats = user_db.get_user_stats(user_id)
-    is_premium = stats["is_premium"]
-    is_admin = ADMIN_ID != 0 and str(user_id) == str(ADMIN_ID)
-    
-    if not is_premium and not is_admin:
-        text = f"""
+PUMPDUMP_DENIED_TEXT = MessageTemplate("""
 🔒 **ДОСТУП ЗАПРЕЩЕН!** 🔒
 
 📈 **Pump/Dump мониторинг доступен ИСКЛЮЧИТЕЛЬНО для премиум пользователей!**
 
 📊 **Ваша статистика:**
 • Статус: 🎯 БЕСПЛАТНЫЙ
-• Сигналов сегодня: {stats['signals_today']}/1
-• Всего сигналов: {stats['total_signals']}
+• Сигналов сегодня: {signals_today}/1
+• Всего сигналов: {total_signals}
 
 💎 **Премиум подписка включает:**
 • 24/7 мониторинг pump/dump сигналов (реальные данные)
@@ -575,143 +3457,61 @@ async def pumpdump_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 📋 **Оформить подписку:** /premium
 
 ⚠️ **Без премиума функция Pump/Dump НЕДОСТУПНА**
-"""
-        await update.message.reply_text(text, reply_markup=get_main_keyboard(user_id))
-        return
-    
-    # Если пользователь премиум или админ
-    loading_msg = await update.message.reply_text("🔍 Анализирую реальные данные рынка...")
-    
-    try:
-        # Берем случайные 10 монет для анализа
-        symbols = random.sample(list(COINGECKO_IDS.keys())[:20], 10)
-        
-        # Получаем данные для всех монет
-        all_data = coingecko_client.get_multiple_coins(symbols)
-        
-        await loading_msg.delete()
-        
-        alerts = []
-        for symbol, coin_data in all_data.items():
-            change = coin_data.get('change_24h', 0)
-            price = coin_data.get('price', 0)
-            
-            # Критерии для Pump/Dump
-            if change > 12:
-                alert_type = "🚀 PUMP"
-                intensity = "🔥 СИЛЬНЫЙ" if change > 18 else "📈 УМЕРЕННЫЙ"
-                action = "SELL" if change > 20 else "CAUTIOUS BUY"
-                alerts.append({
-                    'symbol': symbol,
-                    'type': alert_type,
-                    'change': change,
-                    'price': price,
-                    'intensity': intensity,
-                    'action': action
-                })
-            elif change < -12:
-                alert_type = "🔻 DUMP"
-                intensity = "💥 СИЛЬНЫЙ" if change < -18 else "📉 УМЕРЕННЫЙ"
-                action = "BUY" if change < -20 else "WAIT"
-                alerts.append({
-                    'symbol': symbol,
-                    'type': alert_type,
-                    'change': change,
-                    'price': price,
-                    'intensity': intensity,
-                    'action': action
-                })
-        
-        # Отправляем алерты если есть
-        if alerts:
-            for alert in alerts[:3]:  # Ограничиваем 3 алерта
-                text = f"""
-{alert['type']} **ОБНАРУЖЕН!** ⚡
-
-🏷 **Пара:** {alert['symbol']}/USDT
-💰 **Реальная цена:** {format_price(alert['price'])}
-📊 **Изменение 24ч:** {alert['change']:+.1f}%
-💪 **Интенсивность:** {alert['intensity']}
-⚡ **Рекомендуемое действие:** {alert['action']}
-
-⏰ **Время обнаружения:** {datetime.now().strftime('%H:%M %d.%m.%Y')}
-📡 **Источник данных:** CoinGecko API
-
-🎯 **Критерий сигнала:** изменение цены на {abs(alert['change']):.1f}% за 24 часа
-"""
-                await update.message.reply_text(text, reply_markup=get_main_keyboard(user_id))
-                await asyncio.sleep(0.3)
-            
-            info_text = f"""
-✅ **Pump/Dump мониторинг завершен!**
+""")
 
-📊 **Найдены активные сигналы:** {len(alerts)}
-🔍 **Проанализировано:** {len(all_data)} монет
-{'💎 **Ваш статус:** ПРЕМИУМ ✅' if is_premium else '👑 **Администратор**'}
+PUMPDUMP_ALERT = MessageTemplate("""
+{type} **ОБНАРУЖЕН!** ⚡
 
-⚡ **Параметры анализа:**
-• Проверено: {len(all_data)} монет
-• Критерий pump: рост >12% за 24ч
-• Критерий dump: падение >12% за 24ч
-• Время анализа: {datetime.now().strftime('%H:%M')}
-• Источник данных: CoinGecko API
-"""
-        else:
-            info_text = f"""
-📊 **АНАЛИЗ РЫНКА ЗАВЕРШЕН**
+🏷 **Пара:** {symbol}/USDT
+💰 **Реальная цена:** {price}
+📊 **Изменение 24ч:** {change:+.1f}%
+⏱ **Изменение 1ч:** {change_1h}
+💪 **Интенсивность:** {intensity}
+⚡ **Рекомендуемое действие:** {action}
 
-✅ **Активных Pump/Dump сигналов не обнаружено.**
-Рынок находится в стабильном состоянии.
+⏰ **Время обнаружения:** {detected}
+📡 **Источник данных:** CoinGecko API
 
-{'💎 **Ваш статус:** ПРЕМИУМ ✅' if is_premium else '👑 **Администратор**'}
+🎯 **Критерий сигнала:** {reason}
+""")
 
+PUMPDUMP_PARAMETERS = """
 ⚡ **Параметры анализа:**
-• Проверено: {len(all_data)} монет
-• Критерий pump: рост >12% за 24ч
-• Критерий dump: падение >12% за 24ч
-• Время анализа: {datetime.now().strftime('%H:%M')}
+• Проверено: {scanned} монет
+• Критерий pump: рост >{change_threshold:g}% за 24ч
+• Критерий dump: падение >{change_threshold:g}% за 24ч
+• Аномалия: движение за 1ч ≥{z_threshold:g}σ от волатильности
+• Время анализа: {analysis_time}
 • Источник данных: CoinGecko API
 """
-        
-        await update.message.reply_text(info_text, reply_markup=get_main_keyboard(user_id))
-        
-    except Exception as e:
-        logger.error(f"Ошибка pump/dump: {e}")
-        await update.message.reply_text(
-            "⚠️ Ошибка анализа рыночных данных. Попробуйте позже.",
-            reply_markup=get_main_keyboard(user_id)
-        )
 
-async def premium_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Информация о подписке"""
-    user = update.effective_user
-    user_id = user.id
-    
-    stats = user_db.get_user_stats(user_id)
-    is_premium = stats["is_premium"]
-    
-    if is_premium:
-        expiry = stats['premium_expiry']
-        if expiry:
-            try:
-                expiry_date = datetime.fromisoformat(expiry)
-                expiry_str = expiry_date.strftime('%d.%m.%Y')
-                days_left = (expiry_date - datetime.now()).days
-            except:
-                expiry_str = "Бессрочно"
-                days_left = "∞"
-        else:
-            expiry_str = "Бессрочно"
-            days_left = "∞"
-        
-        text = f"""
+PUMPDUMP_FOUND_TEXT = MessageTemplate("""
+✅ **Pump/Dump мониторинг завершен!**
+
+📊 **Найдены активные сигналы:** {found}
+🔍 **Проанализировано:** {scanned} монет
+{role}
+""" + PUMPDUMP_PARAMETERS,
+    change_threshold=PUMPDUMP_CHANGE_THRESHOLD, z_threshold=PUMPDUMP_Z_THRESHOLD)
+
+PUMPDUMP_NONE_TEXT = MessageTemplate("""
+📊 **АНАЛИЗ РЫНКА ЗАВЕРШЕН**
+
+✅ **Активных Pump/Dump сигналов не обнаружено.**
+Рынок находится в стабильном состоянии.
+
+{role}
+""" + PUMPDUMP_PARAMETERS,
+    change_threshold=PUMPDUMP_CHANGE_THRESHOLD, z_threshold=PUMPDUMP_Z_THRESHOLD)
+
+PREMIUM_ACTIVE_TEXT = MessageTemplate("""
 💎 **ВАША ПРЕМИУМ ПОДПИСКА АКТИВНА**
 
 ✅ **Статус:** Активен
-📅 **Истекает:** {expiry_str}
+📅 **Истекает:** {expiry}
 ⏳ **Осталось дней:** {days_left}
-📊 **Всего сигналов:** {stats['total_signals']}
-📈 **Сигналов сегодня:** {stats['signals_today']}
+📊 **Всего сигналов:** {total_signals}
+📈 **Сигналов сегодня:** {signals_today}
 
 🔔 **Доступные функции:**
 • ✅ Неограниченные торговые сигналы (реальные данные)
@@ -721,9 +3521,9 @@ async def premium_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • ✅ Расширенный анализ рынка
 
 ⚠️ **Предупреждение:** Торговля криптовалютами связана с рисками.
-"""
-    else:
-        text = f"""
+""")
+
+PREMIUM_OFFER_TEXT = MessageTemplate("""
 💎 **ПРЕМИУМ ПОДПИСКА YESsignals**
 
 ⏳ **Срок:** 30 дней
@@ -754,20 +3554,9 @@ async def premium_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • Сигналы основаны на реальных данных с бирж
 • Проводите собственный анализ
 • Торговля сопряжена с рисками
-"""
-    
-    keyboard = [
-        [InlineKeyboardButton("📤 Отправить чек", url="https://t.me/YESsignals_support_bot")],
-        [InlineKeyboardButton("🆘 Поддержка", callback_data="support")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="back")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(text, reply_markup=reply_markup)
+""")
 
-async def support_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Поддержка"""
-    text = """
+SUPPORT_TEXT = """
 🆘 **ТЕХНИЧЕСКАЯ ПОДДЕРЖКА**
 
 🤖 **Бот поддержки:**
@@ -788,17 +3577,466 @@ async def support_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 ⚠️ **Администрация не предоставляет финансовых консультаций.**
 """
+
+ADMIN_PANEL_TEXT = (
+    "👑 **Админ-панель**\n\n"
+    "Команды:\n"
+    "/activate <id>[,<id>...] [дни] - активировать премиум\n"
+    "📎 CSV-файл (id[,дни] в строке) - пакетная активация\n"
+    "/stats - статистика\n\n"
+    "⚠️ Используйте команды в чате"
+)
+
+ADMIN_ONLY_TEXT = "⛔ Команда доступна только администратору"
+
+ACTIVATE_USAGE_TEXT = (
+    "📋 **Активация премиума**\n\n"
+    "/activate 123456789 - на 30 дней\n"
+    "/activate 123456789 90 - на 90 дней\n"
+    "/activate 111,222,333 30 - несколько пользователей\n"
+    "📎 Или отправьте CSV-файл: id[,дни] в каждой строке"
+)
+
+ADMIN_STATS_TEXT = MessageTemplate("""
+📊 **СТАТИСТИКА БОТА**
+
+👥 **Пользователей:** {users}
+💎 **Активных премиум:** {premium}
+⏳ **Истекает за {expiring_days} дней:** {expiring_week}
+
+🎯 **Сигналов сегодня:** {signals_today}
+🙋 **Активных сегодня:** {active_today}
+📈 **Всего сигналов:** {signals_total}
+
+⏰ **Время:** {generated}
+""", expiring_days=PREMIUM_EXPIRING_STATS_DAYS)
+
+ACTIVATION_DONE_TEXT = MessageTemplate("""
+✅ **Премиум активирован**
+
+👥 **Пользователей:** {activated}
+🆕 **Новых в базе:** {created}
+⚠️ **Пропущено:** {skipped}
+{details}""")
+
+PREMIUM_ACTIVATED_TEXT = MessageTemplate("""
+✅ **Ваш премиум активирован!**
+
+📅 **Действует до:** {expiry}
+
+💎 Неограниченные сигналы и Pump/Dump мониторинг уже доступны.
+👉 /start
+""")
+
+HELP_TEXT = (
+    "🤖 **Используйте кнопки меню!**\n\n"
+    "**Доступные команды:**\n"
+    "/start - Главное меню\n"
+    "/signals - Торговые сигналы (реальные данные)\n"
+    "/signals BTC - Сигнал по конкретной монете\n"
+    "/premium - Информация о подписке\n"
+    "/support - Техническая поддержка\n\n"
+    "⚠️ Все общение с администрацией только через @YESsignals_support_bot"
+)
+
+# ================== ТАБЛИЦА СИГНАЛОВ ==================
+class SignalTable:
+    """Сигналы, рассчитанные один раз на каждое обновление цены монеты.
+    
+    Ключ - (символ, время данных, источник): все пользователи, запросившие
+    монету на одних и тех же данных, получают один и тот же сигнал. Источник
+    в ключе нужен, чтобы после теплого старта свежий ответ API с тем же
+    временем данных заменил сигнал по сохраненному снимку. Старые
+    записи (до SIGNAL_TABLE_SIZE) остаются для разбора истории сигналов.
+    """
+    
+    def __init__(self, client, max_entries=SIGNAL_TABLE_SIZE):
+        self.client = client  # источник монет вне снимка (в воркере - главный процесс)
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (символ, время данных, источник) -> сигнал
+        self.current = {}  # символ -> ключ актуального сигнала
+        self.stats = {'built': 0, 'hits': 0, 'misses': 0}
+    
+    def rebuild(self, snapshot):
+        """Пересчитать сигналы для монет, у которых обновились данные"""
+        for symbol, coin_data in snapshot.coins.items():
+            key = self.key(symbol, coin_data)
+            if self.current.get(symbol) == key:
+                continue
+            self._build(key, coin_data)
+            self.current[symbol] = key
+        self._prune()
+    
+    @staticmethod
+    def key(symbol, coin_data):
+        return symbol, coin_data.get('last_updated'), coin_data.get('source')
+    
+    def _build(self, key, coin_data):
+        signal = self.entries.get(key)
+        if signal is None:
+            signal = self.entries[key] = generate_signal_from_real_data(coin_data)
+            self.stats['built'] += 1
+        return signal
+    
+    def _prune(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+    
+    async def fetch(self, symbol):
+        """Сигнал по любой монете реестра: вне снимка рынка данные идут через кеш CoinGecko"""
+        if symbol in self.current:
+            return self.get(symbol)
+        coin_data = await self.client.get_coin_data(symbol)
+        if not coin_data:
+            return None
+        signal = self._build(self.key(symbol, coin_data), coin_data)
+        self._prune()
+        return signal
+    
+    def lookup(self, symbol, timestamp, source='CoinGecko'):
+        """Сигнал для конкретных данных (для разбора истории)"""
+        return self.entries.get((symbol, timestamp, source))
+    
+    def get(self, symbol):
+        """Актуальный сигнал по монете"""
+        key = self.current.get(symbol)
+        if key is not None:
+            signal = self.entries.get(key)
+            if signal is not None:
+                self.stats['hits'] += 1
+                return signal
+        
+        # Снимок еще не загружен - считаем по резервным данным без сохранения
+        self.stats['misses'] += 1
+        coin_data = get_market_data(symbol)
+        if not coin_data:
+            return None
+        return generate_signal_from_real_data(coin_data)
+
+signal_table = SignalTable(coingecko_client)
+market_poller.add_listener(signal_table.rebuild)
+
+# ================== КОМАНДЫ БОТА ==================
+@observed
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /start"""
+    user = update.effective_user
+    user_id = user.id
+    
+    async with user_db.session(user_id) as session:
+        session.update(username=user.username)
+        stats = session.stats()
+    is_premium = stats["is_premium"]
+    
+    text = START_TEXT.render(
+        first_name=user.first_name,
+        user_id=user_id,
+        status=STATUS_LABELS[is_premium],
+        signals_today=stats['signals_today'],
+        total_signals=stats['total_signals'],
+        pumpdump_access=PUMPDUMP_ACCESS_LABELS[is_premium]
+    )
+    
+    await reply(update, text, reply_markup=get_main_keyboard(user_id))
+
+@observed
+async def signals_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Получить торговые сигналы с реальными данными"""
+    # Запросы одного пользователя выполняются по очереди, разных - параллельно.
+    # Все изменения пользователя сохраняются одной записью в конце
+    async with user_db.session(update.effective_user.id) as session:
+        await send_signals(update, context, session)
+
+async def send_signals(update: Update, context: ContextTypes.DEFAULT_TYPE, session):
+    """Списать сигнал из лимита и отправить его (в рамках сессии пользователя)"""
+    user = update.effective_user
+    user_id = user.id
+    
+    # /signals <МОНЕТА> - сигнал по конкретной монете
+    requested = context.args[0].lstrip('$').upper() if context and context.args else None
+    if requested and coin_registry.resolve(requested) is None:
+        await reply(
+            update,
+            f"❓ Монета {requested[:20]} не найдена. Пример: /signals BTC",
+            reply_markup=get_main_keyboard(user_id)
+        )
+        return
+    
+    # Проверяем лимит и сразу списываем сигнал
+    if not session.consume_signal():
+        stats = session.stats()
+        
+        text = LIMIT_REACHED_TEXT.render(
+            status=LIMIT_STATUS_LABELS[stats['is_premium']],
+            signals_today=stats['signals_today'],
+            total_signals=stats['total_signals']
+        )
+        await reply(update, text, reply_markup=get_main_keyboard(user_id))
+        return
+    
+    # Показываем статус
+    stats = session.stats()
+    is_premium = stats["is_premium"]
+    sent = 0
+    
+    try:
+        if requested:
+            signal = await signal_table.fetch(requested)
+            signals = [signal] if signal else []
+        else:
+            # Выбираем монеты в зависимости от статуса
+            if is_premium:
+                # Для премиум: 3 разные монеты из топ-15
+                symbols = random.sample(coin_registry.tier('premium'), 3)
+            else:
+                # Для бесплатных: 1 монета из топ-10
+                symbols = [random.choice(coin_registry.tier('free'))]
+            
+            # Сигналы уже рассчитаны для текущего снимка рынка
+            signals = [signal for signal in map(signal_table.get, symbols) if signal]
+        
+        if not signals:
+            session.refund_signal()
+            await reply(
+                update,
+                "⚠️ Временно не удалось получить данные с бирж. Попробуйте позже.",
+                reply_markup=get_main_keyboard(user_id)
+            )
+            return
+        
+        # Отправляем сигналы
+        for signal in signals:
+            text = render_signal(signal, is_premium, stats['signals_today'])
+            await reply(update, text, reply_markup=get_main_keyboard(user_id))
+            sent += 1
+        
+    except Exception as e:
+        logger.error("Ошибка получения сигналов: %s", e)
+        if not sent:
+            session.refund_signal()
+        await reply(
+            update,
+            "⚠️ Ошибка получения данных. Попробуйте позже.",
+            reply_markup=get_main_keyboard(user_id)
+        )
+
+@observed
+async def pumpdump_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Pump/Dump мониторинг с реальными данными"""
+    user = update.effective_user
+    user_id = user.id
+    
+    # СТРОГАЯ проверка премиум статуса
+    async with user_db.session(user_id) as session:
+        stats = session.stats()
+    is_premium = stats["is_premium"]
+    if not is_premium and not is_admin(user_id):
+        text = PUMPDUMP_DENIED_TEXT.render(
+            signals_today=stats['signals_today'],
+            total_signals=stats['total_signals']
+        )
+        await reply(update, text, reply_markup=get_main_keyboard(user_id))
+        return
+    
+    # Если пользователь премиум или админ
+    try:
+        result = pumpdump_scanner.result
+        if not result.scanned:
+            # Сканер еще не отработал - оцениваем текущий снимок рынка
+            result = pumpdump_scanner.evaluate(
+                MarketColumns.from_snapshot(market_poller.snapshot, price_history), use_history=False
+            )
+        alerts = result.alerts
+        scanned = result.scanned
+        analysis_time = datetime.fromtimestamp(result.fetched_at or time.time()).strftime('%H:%M')
+        
+        # Отправляем алерты если есть
+        if alerts:
+            for alert in alerts[:3]:  # Ограничиваем 3 алерта
+                text = render_pumpdump_alert(alert, result.fetched_at)
+                await reply(update, text, reply_markup=get_main_keyboard(user_id))
+            
+            info_text = PUMPDUMP_FOUND_TEXT.render(
+                found=len(alerts),
+                scanned=scanned,
+                role=PUMPDUMP_ROLE_LABELS[is_premium],
+                analysis_time=analysis_time
+            )
+        else:
+            info_text = PUMPDUMP_NONE_TEXT.render(
+                scanned=scanned,
+                role=PUMPDUMP_ROLE_LABELS[is_premium],
+                analysis_time=analysis_time
+            )
+        
+        await reply(update, info_text, reply_markup=get_main_keyboard(user_id))
+        
+    except Exception as e:
+        logger.error("Ошибка pump/dump: %s", e)
+        await reply(
+            update,
+            "⚠️ Ошибка анализа рыночных данных. Попробуйте позже.",
+            reply_markup=get_main_keyboard(user_id)
+        )
+
+@observed
+async def premium_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Информация о подписке"""
+    user = update.effective_user
+    user_id = user.id
+    
+    async with user_db.session(user_id) as session:
+        stats = session.stats()
+        expiry_date = session.premium_expiry
+    is_premium = stats["is_premium"]
+    
+    if is_premium:
+        if expiry_date:
+            expiry_str = expiry_date.strftime('%d.%m.%Y')
+            days_left = (expiry_date - datetime.now()).days
+        else:
+            expiry_str = "Бессрочно"
+            days_left = "∞"
+        
+        text = PREMIUM_ACTIVE_TEXT.render(
+            expiry=expiry_str,
+            days_left=days_left,
+            total_signals=stats['total_signals'],
+            signals_today=stats['signals_today']
+        )
+    else:
+        text = PREMIUM_OFFER_TEXT.render(user_id=user_id)
+    
+    await reply(update, text, reply_markup=PREMIUM_INLINE_KEYBOARD)
+
+@observed
+async def support_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Поддержка"""
+    await reply(update, SUPPORT_TEXT, reply_markup=SUPPORT_INLINE_KEYBOARD)
+
+# ================== АДМИН-КОМАНДЫ ==================
+def parse_activation_entry(user_id, days=None):
+    """(user_id, дни) из строк; ValueError если значения некорректны"""
+    user_id = int(str(user_id).strip())
+    days = PREMIUM_DEFAULT_DAYS if days is None or not str(days).strip() else int(str(days).strip())
+    if user_id <= 0 or not 0 < days <= PREMIUM_MAX_DAYS:
+        raise ValueError(f"{user_id} {days}")
+    return user_id, days
+
+def parse_activation_args(args):
+    """/activate 111,222 [дни] -> ([(id, дни)], некорректные значения).
     
-    keyboard = [
-        [InlineKeyboardButton("🤖 Написать в поддержку", url="https://t.me/YESsignals_support_bot")],
-        [InlineKeyboardButton("💎 Оформить подписку", callback_data="subscription")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="back")]
+    ValueError с лишними аргументами, если после дней что-то осталось.
+    """
+    # "111, 222" - пробел после запятой не отделяет дни от списка id
+    tokens = []
+    for token in args:
+        if tokens and (tokens[-1].endswith(',') or token.startswith(',')):
+            tokens[-1] += token
+        else:
+            tokens.append(token)
+    if len(tokens) > 2:
+        raise ValueError(' '.join(tokens[2:]))
+    days = tokens[1] if len(tokens) > 1 else None
+    grants, errors = [], []
+    for raw_id in tokens[0].split(','):
+        if not raw_id.strip():
+            continue
+        try:
+            grants.append(parse_activation_entry(raw_id, days))
+        except ValueError:
+            errors.append(raw_id.strip())
+    return grants, errors
+
+def parse_activation_csv(data):
+    """CSV оплат: id[,дни] в строке; заголовок и пустые строки пропускаются"""
+    grants, errors = [], []
+    text = data.decode('utf-8-sig', errors='replace')
+    for line_no, row in enumerate(csv.reader(io.StringIO(text)), start=1):
+        cells = [cell.strip() for cell in row]
+        if not cells or not cells[0] or cells[0].startswith('#'):
+            continue
+        try:
+            grants.append(parse_activation_entry(cells[0], cells[1] if len(cells) > 1 else None))
+        except ValueError:
+            if line_no > 1:  # первая строка может быть заголовком
+                errors.append(f"строка {line_no}")
+    return grants, errors
+
+async def notify_activated(activated):
+    """Сообщить пользователям об активации (после ответов в очереди)"""
+    futures = [
+        outbound.submit(
+            user_id,
+            PREMIUM_ACTIVATED_TEXT.render(
+                expiry=datetime.fromisoformat(expiry).strftime('%d.%m.%Y') if expiry else "Бессрочно"
+            ),
+            PRIORITY_BROADCAST
+        )
+        for user_id, expiry in activated
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    failed = sum(isinstance(result, Exception) for result in results)
+    if failed:
+        logger.warning("⚠️ Уведомление об активации не доставлено: %s из %s", failed, len(results))
+
+@observed
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Статистика бота (только для админа)"""
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        await reply(update, ADMIN_ONLY_TEXT)
+        return
+    
+    text = ADMIN_STATS_TEXT.render(
+        generated=datetime.now().strftime('%H:%M %d.%m.%Y'),
+        **user_db.stats()
+    )
+    await reply(update, text, reply_markup=get_main_keyboard(user_id))
+
+@observed
+async def activate_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Активация премиума: список id в команде или CSV-файл оплат (только для админа)"""
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        await reply(update, ADMIN_ONLY_TEXT)
+        return
+    
+    document = update.message.document if update.message else None
+    if document is not None:
+        if document.file_size and document.file_size > ACTIVATION_CSV_MAX_BYTES:
+            await reply(update, "⚠️ CSV-файл слишком большой")
+            return
+        file = await document.get_file()
+        grants, errors = parse_activation_csv(bytes(await file.download_as_bytearray()))
+    elif context.args:
+        try:
+            grants, errors = parse_activation_args(context.args)
+        except ValueError as e:
+            # "/activate 111 222 333" не должен молча выдать 111 премиум на 222 дня
+            await reply(update, f"⚠️ Лишние аргументы: {e}\nid перечисляются через запятую\n\n{ACTIVATE_USAGE_TEXT}")
+            return
+    else:
+        await reply(update, ACTIVATE_USAGE_TEXT)
+        return
+    
+    if not grants:
+        await reply(update, f"⚠️ Нет корректных id для активации\n\n{ACTIVATE_USAGE_TEXT}")
+        return
+    
+    activated, created = user_db.activate_premium(grants)
+    start_background_task(notify_activated(activated), "activation-notify")
     
-    await update.message.reply_text(text, reply_markup=reply_markup)
+    details = f"Некорректные: {', '.join(errors[:10])}{' ...' if len(errors) > 10 else ''}\n" if errors else ""
+    await reply(update, ACTIVATION_DONE_TEXT.render(
+        activated=len(activated),
+        created=created,
+        skipped=len(errors),
+        details=details
+    ))
 
 # ================== ОБРАБОТЧИК КНОПОК ==================
+@observed
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик inline-кнопок"""
     query = update.callback_query
@@ -808,7 +4046,8 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     data = query.data
     
     if data == "back":
-        await query.message.reply_text(
+        await reply(
+            update,
             "🔙 Возврат в главное меню",
             reply_markup=get_main_keyboard(user_id)
         )
@@ -820,6 +4059,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await premium_command(update, context)
 
 # ================== ОБРАБОТЧИК ТЕКСТОВЫХ СООБЩЕНИЙ ==================
+@observed
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик текстовых сообщений (кнопок меню)"""
     text = update.message.text
@@ -837,28 +4077,426 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif text == "🆘 Поддержка":
         await support_command(update, context)
     
-    elif text == "👑 Админ" and str(user_id) == str(ADMIN_ID) and ADMIN_ID != 0:
-        await update.message.reply_text(
-            "👑 **Админ-панель**\n\n"
-            "Команды:\n"
-            "/activate <id> [дни] - активировать премиум\n"
-            "/stats - статистика\n\n"
-            "⚠️ Используйте команды в чате"
-        )
+    elif text == "👑 Админ" and is_admin(user_id):
+        await reply(update, ADMIN_PANEL_TEXT)
     
     else:
-        await update.message.reply_text(
-            "🤖 **Используйте кнопки меню!**\n\n"
-            "**Доступные команды:**\n"
-            "/start - Главное меню\n"
-            "/signals - Торговые сигналы (реальные данные)\n"
-            "/premium - Информация о подписке\n"
-            "/support - Техническая поддержка\n\n"
-            "⚠️ Все общение с администрацией только через @YESsignals_support_bot",
-            reply_markup=get_main_keyboard(user_id)
+        await reply(update, HELP_TEXT, reply_markup=get_main_keyboard(user_id))
+
+# ================== ФОНОВЫЕ ЗАДАЧИ ==================
+background_tasks = set()
+
+def start_background_task(coro, name):
+    task = asyncio.create_task(coro, name=name)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def stop_background_tasks():
+    for task in list(background_tasks):
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+
+class AlertBroadcaster:
+    """Рассылка новых pump/dump алертов всем активным премиум подписчикам.
+    
+    Сканер только кладет алерты в очередь; рассылку ведет отдельная задача,
+    поэтому интерактивные обработчики ее не ждут.
+    """
+    
+    def __init__(self, db):
+        self.db = db
+        self.queue = asyncio.Queue()
+        self._last_sent = {}  # (монета, окно, тип) -> time.monotonic() последней рассылки
+        self.stats = {'alerts': 0, 'messages': 0, 'failed': 0}
+    
+    def on_scan(self, result):
+        """Обработчик сканера: отбросить повторы и поставить новые алерты в очередь"""
+        now = time.monotonic()
+        new_alerts = []
+        for alert in result.alerts:
+            key = (alert['coin_id'], alert['window'], alert['type'])
+            cooldown = PUMPDUMP_ALERT_COOLDOWN.get(alert['window'], 3600)
+            last = self._last_sent.get(key)
+            if last is not None and now - last < cooldown:
+                continue
+            new_alerts.append((key, alert))
+            if len(new_alerts) >= PUMPDUMP_PUSH_MAX_ALERTS:
+                break
+        
+        # Старые ключи больше не нужны
+        horizon = max(PUMPDUMP_ALERT_COOLDOWN.values())
+        for key in [k for k, t in self._last_sent.items() if now - t >= horizon]:
+            del self._last_sent[key]
+        
+        # Повторы гасятся только для разосланных алертов: не попавшие в лимит
+        # уйдут со следующим сканированием
+        for key, alert in new_alerts:
+            self._last_sent[key] = now
+            self.queue.put_nowait((alert, result.fetched_at))
+    
+    async def run(self):
+        """Разослать алерты из очереди по одному"""
+        while True:
+            alert, detected_at = await self.queue.get()
+            try:
+                await self.fan_out(alert, detected_at)
+            except Exception as e:
+                logger.error("❌ Ошибка рассылки алерта: %s", e)
+    
+    async def fan_out(self, alert, detected_at):
+        text = render_pumpdump_alert(alert, detected_at)
+        recipients = tuple(self.db.premium_subscriber_ids())
+        self.stats['alerts'] += 1
+        # Темп отправки задает outbound; ответы пользователям идут вне очереди рассылки
+        results = await asyncio.gather(
+            *(outbound.submit(chat_id, text, PRIORITY_BROADCAST) for chat_id in recipients),
+            return_exceptions=True
+        )
+        failed = sum(isinstance(r, Exception) for r in results)
+        self.stats['messages'] += len(recipients) - failed
+        self.stats['failed'] += failed
+        logger.info("📣 Алерт %s %s разослан: %s подписчиков", alert['symbol'], alert['type'], len(recipients))
+
+alert_broadcaster = AlertBroadcaster(user_db)
+pumpdump_scanner.add_listener(alert_broadcaster.on_scan)
+
+async def send_premium_reminders(users):
+    """Напомнить об окончании подписки (один раз на каждый срок)"""
+    futures = [
+        outbound.submit(
+            user["id"],
+            f"⏳ **Ваша премиум подписка истекает "
+            f"{datetime.fromisoformat(user['premium_expiry']).strftime('%d.%m.%Y')}**\n\n"
+                 "Продлите подписку, чтобы не потерять неограниченные сигналы "
+                 "и Pump/Dump мониторинг.\n"
+                 "👉 /premium",
+            PRIORITY_BROADCAST
         )
+        for user in users
+    ]
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    failed = sum(isinstance(result, Exception) for result in results)
+    if failed:
+        logger.warning("⚠️ Напоминание о премиуме не доставлено: %s из %s", failed, len(results))
+
+async def premium_expiry_job():
+    """Снятие истекших подписок пачками и напоминания о скором окончании"""
+    last_reminders = None
+    while True:
+        try:
+            while user_db.expire_due_premiums():
+                await asyncio.sleep(0)
+            if last_reminders is None or time.monotonic() - last_reminders >= PREMIUM_REMINDER_INTERVAL:
+                last_reminders = time.monotonic()
+                users = user_db.pending_premium_reminders(PREMIUM_REMINDER_DAYS * 86400)
+                if users:
+                    # Отмечаем сразу: доставка идет отдельной задачей и не держит проверку сроков
+                    user_db.mark_premium_reminded(users)
+                    start_background_task(send_premium_reminders(users), "premium-reminders")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("❌ Ошибка проверки сроков премиума: %s", e)
+        await asyncio.sleep(PREMIUM_SWEEP_INTERVAL)
+
+# ================== WEBHOOK ==================
+def create_http_app(application, loop):
+    """Flask-приложение: принимает обновления Telegram и кладет их в очередь Application"""
+    http_app = Flask(__name__)
+    
+    @http_app.post(WEBHOOK_PATH)
+    def telegram_webhook():
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        # Без секрета webhook не запускается (main), пустой токен не пройдет
+        if not WEBHOOK_SECRET or not hmac.compare_digest(token, WEBHOOK_SECRET):
+            return "", 403
+        
+        data = request.get_json(silent=True)
+        if data is None:
+            return "", 400
+        
+        # Обработка идет в event loop бота, Telegram получает ответ сразу
+        update = Update.de_json(data, application.bot)
+        asyncio.run_coroutine_threadsafe(application.update_queue.put(update), loop)
+        return "", 200
+    
+    @http_app.get("/healthz")
+    def healthz():
+        return "ok", 200
+    
+    return http_app
+
+def add_metrics_route(http_app):
+    @http_app.get("/metrics")
+    def metrics_endpoint():
+        return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+def start_metrics_server(port=METRICS_PORT):
+    """Отдельный HTTP-сервер метрик (не на публичном webhook-порту)"""
+    http_app = Flask(__name__)
+    add_metrics_route(http_app)
+    server = create_server(http_app, host=METRICS_HOST, port=port, threads=2)
+    threading.Thread(target=server.run, name="metrics-server", daemon=True).start()
+    logger.info("📈 Метрики: http://%s:%s/metrics", METRICS_HOST, port)
+    return server
+
+def stop_event_on_signals(loop):
+    """asyncio.Event, выставляемое по SIGINT/SIGTERM"""
+    stop_event = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass  # Windows
+    return stop_event
+
+async def set_webhook(bot):
+    await bot.set_webhook(
+        url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=Update.ALL_TYPES,
+        drop_pending_updates=True
+    )
+
+async def run_webhook(application: Application):
+    """Webhook-режим: waitress принимает HTTP, Application обрабатывает обновления"""
+    loop = asyncio.get_running_loop()
+    stop_event = stop_event_on_signals(loop)
+    
+    server = create_server(
+        create_http_app(application, loop),
+        host=WEBHOOK_HOST,
+        port=WEBHOOK_PORT,
+        threads=WEBHOOK_THREADS
+    )
+    # Поток сервера - daemon: при остановке процесса не ждем открытые соединения
+    server_thread = threading.Thread(target=server.run, name="webhook-server", daemon=True)
+    
+    async with application:
+        await on_startup(application)
+        await application.start()
+        await set_webhook(application.bot)
+        server_thread.start()
+        logger.info("🌐 Webhook слушает %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+        
+        await stop_event.wait()
+        
+        server.close()
+        await application.stop()
+        await on_shutdown(application)
 
 # ================== ЗАПУСК ==================
+async def on_startup(application: Application):
+    """Запуск фоновых задач"""
+    user_db.start_background()
+    outbound.start(application.bot)
+    coin_registry.start()
+    market_poller.warm_start()
+    market_poller.start()
+    pumpdump_scanner.start()
+    start_background_task(premium_expiry_job(), "premium-expiry")
+    start_background_task(alert_broadcaster.run(), "alert-broadcast")
+
+async def on_shutdown(application: Application):
+    """Освобождение ресурсов при остановке"""
+    await stop_background_tasks()
+    await market_poller.stop()
+    await coin_registry.stop()
+    await pumpdump_scanner.stop()
+    await outbound.stop()
+    await coingecko_client.close()
+    await user_db.close()
+
+def register_handlers(application: Application):
+    """Команды и обработчики бота (используется также в bench.py)"""
+    # Основные команды
+    application.add_handler(CommandHandler("start", start_command))
+    application.add_handler(CommandHandler("signals", signals_command))
+    application.add_handler(CommandHandler("premium", premium_command))
+    application.add_handler(CommandHandler("support", support_command))
+    application.add_handler(CommandHandler("pumpdump", pumpdump_command))
+    
+    # Админ-команды (доступ проверяется внутри)
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("activate", activate_command))
+    application.add_handler(MessageHandler(filters.Document.FileExtension("csv"), activate_command))
+    
+    # Обработчики
+    application.add_handler(CallbackQueryHandler(button_handler))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+
+# ================== НЕСКОЛЬКО ПРОЦЕССОВ ==================
+def reuseport_socket(host, port):
+    """Слушающий сокет с SO_REUSEPORT: ядро распределяет соединения между воркерами (Linux)"""
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+async def start_relay_server(path):
+    """Главный процесс: монеты вне снимка для воркеров через общий клиент CoinGecko"""
+    async def coin(request):
+        coin_data = await coingecko_client.get_coin_data(request.query.get('symbol', '').upper())
+        return web.json_response(dict(coin_data) if coin_data else None)
+    
+    relay_app = web.Application()
+    relay_app.router.add_get('/coin', coin)
+    runner = web.AppRunner(relay_app, access_log=None)
+    await runner.setup()
+    await web.UnixSite(runner, path).start()
+    return runner
+
+class RelayCoinClient:
+    """Воркер: get_coin_data через главный процесс.
+    
+    Лимиты, кеш и объединение одинаковых запросов к CoinGecko - одни на
+    все процессы, поэтому нагрузка на API не растет с числом воркеров.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.cache = TTLCache(max_size=COINGECKO_CACHE_SIZE, ttl=COINGECKO_CACHE_TTL, stale_ttl=0)
+        self._session = None
+    
+    async def get_coin_data(self, symbol):
+        coin_data, state = self.cache.get(symbol)
+        if state == TTLCache.FRESH:
+            return coin_data
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.UnixConnector(path=self.path),
+                timeout=aiohttp.ClientTimeout(total=RELAY_TIMEOUT)
+            )
+        try:
+            async with self._session.get("http://relay/coin", params={'symbol': symbol}) as response:
+                coin_data = await response.json() if response.status == 200 else None
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            logger.warning("⚠️ Главный процесс не ответил по %s: %r", symbol, e)
+            return coingecko_client.get_fallback_data(symbol)
+        if coin_data:
+            self.cache.set(symbol, coin_data)
+        return coin_data
+    
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+async def follow_producer(scan_file):
+    """Воркер: реестр монет и сканер pump/dump ведет главный процесс, здесь только перечитываем файлы"""
+    while True:
+        try:
+            coin_registry.reload_if_changed()
+            result = scan_file.load_if_changed()
+            if result is not None:
+                pumpdump_scanner.result = result
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("❌ Ошибка чтения данных главного процесса: %s", e)
+        await asyncio.sleep(WORKER_SYNC_INTERVAL)
+
+async def on_worker_startup(application: Application, buffer, run_dir):
+    """Воркер обрабатывает обновления: без запросов к CoinGecko и без фоновых рассылок"""
+    signal_table.client = RelayCoinClient(os.path.join(run_dir, RELAY_SOCKET))
+    user_db.start_background()
+    outbound.start(application.bot)
+    coin_registry.load()
+    market_poller.follow(buffer)
+    start_background_task(follow_producer(ScanResultFile(os.path.join(run_dir, SCAN_RESULT_FILE))), "producer-sync")
+
+async def on_worker_shutdown(application: Application):
+    await stop_background_tasks()
+    await market_poller.stop()
+    await outbound.stop()
+    await signal_table.client.close()
+    await coingecko_client.close()
+    await user_db.close()
+
+async def run_worker(buffer_name, run_dir, index):
+    """Процесс-воркер: свой webhook-сервер на общем порту и свой Application"""
+    loop = asyncio.get_running_loop()
+    stop_event = stop_event_on_signals(loop)
+    buffer = SharedSnapshotBuffer(name=buffer_name)
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT + 1 + index)
+    
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES if CONCURRENT_UPDATES > 1 else False)
+        .updater(None)
+        .build()
+    )
+    register_handlers(application)
+    server = create_server(
+        create_http_app(application, loop),
+        sockets=[reuseport_socket(WEBHOOK_HOST, WEBHOOK_PORT)],
+        threads=WEBHOOK_THREADS
+    )
+    server_thread = threading.Thread(target=server.run, name="webhook-server", daemon=True)
+    
+    async with application:
+        await on_worker_startup(application, buffer, run_dir)
+        await application.start()
+        server_thread.start()
+        logger.info("👷 Воркер %s (pid %s) слушает %s:%s%s", index, os.getpid(), WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+        
+        await stop_event.wait()
+        
+        server.close()
+        await application.stop()
+        await on_worker_shutdown(application)
+    buffer.close()
+
+def worker_main(buffer_name, run_dir, index):
+    """Точка входа процесса-воркера"""
+    asyncio.run(run_worker(buffer_name, run_dir, index))
+
+async def run_producer(application: Application, buffer, run_dir):
+    """Главный процесс: снимок рынка, сканер, премиум и рассылки; обновления не обрабатывает"""
+    stop_event = stop_event_on_signals(asyncio.get_running_loop())
+    market_poller.add_listener(buffer.publish)
+    pumpdump_scanner.add_listener(ScanResultFile(os.path.join(run_dir, SCAN_RESULT_FILE)).save)
+    
+    async with application:
+        await on_startup(application)
+        relay = await start_relay_server(os.path.join(run_dir, RELAY_SOCKET))
+        await set_webhook(application.bot)
+        logger.info("🏭 Главный процесс (pid %s): воркеров %s", os.getpid(), WORKERS)
+        
+        await stop_event.wait()
+        
+        await relay.cleanup()
+        await on_shutdown(application)
+
+def run_multiprocess(application: Application):
+    """Один процесс рыночных данных и WORKERS процессов-обработчиков"""
+    buffer = SharedSnapshotBuffer()
+    # Сокет главного процесса и файлы обмена с воркерами
+    run_dir = tempfile.mkdtemp(prefix="yessignals-")
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(target=worker_main, args=(buffer.name, run_dir, index), name=f"bot-worker-{index}")
+        for index in range(WORKERS)
+    ]
+    try:
+        for worker in workers:
+            worker.start()
+        asyncio.run(run_producer(application, buffer, run_dir))
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in workers:
+            worker.join(WORKER_STOP_TIMEOUT)
+        buffer.close()
+        shutil.rmtree(run_dir, ignore_errors=True)
+
 def main():
     """Основная функция запуска"""
     print("=" * 60)
@@ -867,7 +4505,7 @@ def main():
     print("✅ Реальные данные с CoinGecko API")
     print("✅ Нет противоречий в ценах")
     print("✅ Кеширование данных для скорости")
-    print("✅ Резервные данные если API недоступно")
+    print("✅ При недоступности API - последние сохраненные цены")
     print("=" * 60)
     
     if not TELEGRAM_TOKEN:
@@ -883,39 +4521,65 @@ def main():
     
     print("📡 Источник данных: CoinGecko API")
     print("🎯 Монет для анализа: 30+")
-    print("💾 Кеширование: 60 секунд")
+    print(f"💾 Снимок рынка: обновление каждые {MARKET_POLL_INTERVAL} секунд")
     print("=" * 60)
     
+    use_webhook = BOT_MODE == "webhook"
+    if use_webhook and not WEBHOOK_URL:
+        logger.error("❌ BOT_MODE=webhook, но WEBHOOK_URL не задан. Используется polling")
+        use_webhook = False
+    
+    if use_webhook and not WEBHOOK_SECRET:
+        # Иначе любой, кто достучится до порта, сможет прислать поддельные обновления
+        logger.error("❌ BOT_MODE=webhook требует WEBHOOK_SECRET (1-256 символов A-Z, a-z, 0-9, _ и -)")
+        return
+    
+    if WORKERS > 1 and not (use_webhook and DB_BACKEND == "sqlite"):
+        logger.error("❌ WORKERS > 1 требует BOT_MODE=webhook, WEBHOOK_URL и DB_BACKEND=sqlite")
+        return
+    
     try:
-        application = Application.builder().token(TELEGRAM_TOKEN).build()
-        
-        # Основные команды
-        application.add_handler(CommandHandler("start", start_command))
-        application.add_handler(CommandHandler("signals", signals_command))
-        application.add_handler(CommandHandler("premium", premium_command))
-        application.add_handler(CommandHandler("support", support_command))
-        application.add_handler(CommandHandler("pumpdump", pumpdump_command))
-        
-        # Обработчики
-        application.add_handler(CallbackQueryHandler(button_handler))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+        builder = (
+            Application.builder()
+            .token(TELEGRAM_TOKEN)
+            .post_init(on_startup)
+            .post_shutdown(on_shutdown)
+            .concurrent_updates(CONCURRENT_UPDATES if CONCURRENT_UPDATES > 1 else False)
+        )
+        if use_webhook:
+            # Обновления приходят через HTTP, Updater не нужен
+            builder = builder.updater(None)
+        application = builder.build()
+        register_handlers(application)
         
         print("✅ Бот готов к работе!")
         print("💎 Система премиум подписок активна")
-        print("📊 База данных: загружена")
-        print("🔄 Запуск polling...")
+        print(f"📊 База данных: загружена ({DB_BACKEND})")
+        print("🌐 Запуск webhook..." if use_webhook else "🔄 Запуск polling...")
         print("=" * 60)
         
+        if METRICS_PORT:
+            start_metrics_server()
+        
         # Запускаем бота
-        application.run_polling(
-            poll_interval=3.0,
-            timeout=30,
-            drop_pending_updates=True
-        )
+        if WORKERS > 1:
+            run_multiprocess(application)
+        elif use_webhook:
+            asyncio.run(run_webhook(application))
+        else:
+            application.run_polling(
+                poll_interval=3.0,
+                timeout=30,
+                drop_pending_updates=True
+            )
         
     except Exception as e:
-        logger.error(f"❌ Критическая ошибка запуска: {e}")
+        logger.error("❌ Критическая ошибка запуска: %s", e)
         print(f"💥 Ошибка: {e}")
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:2] == ["migrate-db"]:
+        # python bot.py migrate-db - перенос users_db.json в SQLite
+        migrate_json_to_sqlite()
+    else:
+        main()